@@ -4,97 +4,132 @@ Input is the folder path.
 """
 
 # from importlib import reload
+import os.path
+from functools import cached_property
 import numpy as np
 import czifile
 from openpyxl import load_workbook
 from PyQt5 import QtWidgets
 from aicsimageio import AICSImage
-from skimage.filters import gaussian
 
 import LoadRawData
 import SaveReadMatrix
 import ServiceWidgets
+import RawDataCache
+
+
+def provenance_frames(provenance, fnames, ch_numb, crop_roi, pre_nopre_flag, pbar):
+    """Read only the analysed frames of each file, using the file offsets and the time window saved with the analysis."""
+    t_first, t_last  =  provenance['frames_range'].tolist()
+    tlens            =  provenance['files_tlens'].tolist()
+    t_offs           =  provenance['files_t_offsets'].tolist()
+    raw_data         =  None
+    raw_data_mip     =  None
+
+    files_used  =  []                                                                                     # files with analysed frames and the part of the analysed time window inside each of them
+    for cnt in range(len(fnames)):
+        t_start  =  max(t_first, t_offs[cnt])
+        t_end    =  min(t_last, t_offs[cnt] + tlens[cnt])
+        if t_start < t_end:                                                                               # files without analysed frames are not even decoded
+            files_used.append([cnt, t_start, t_end])
+
+    _, frame_shape, raw_dtype  =  LoadRawData.czi_stack_shape([fnames[files_used[0][0]]])
+    files_nbytes               =  [(t_end - t_start) * int(np.prod(frame_shape)) * np.dtype(raw_dtype).itemsize for cnt, t_start, t_end in files_used]
+    t_slices                   =  [slice(t_start - t_offs[cnt], t_end - t_offs[cnt]) for cnt, t_start, t_end in files_used]
+
+    for k, raw_data_bff, raw_data_mip_bff in RawDataCache.iter_czi_files([fnames[ff[0]] for ff in files_used], ch_numb, pre_nopre_flag, files_nbytes, t_slices):     # the next files are decoded meanwhile
+        cnt, t_start, t_end             =  files_used[k]
+        pbar.update_progressbar1(cnt + 1)
+        raw_data_bff                    =  raw_data_bff[:, :, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]      # crop raw matrix accodringly with crop info
+        raw_data_mip_bff                =  raw_data_mip_bff[:, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]     # crop mip matrix accodringly with crop info
+        if raw_data is None:
+            raw_data      =  np.empty((t_last - t_first,) + raw_data_bff.shape[1:], dtype=raw_data_bff.dtype)
+            raw_data_mip  =  np.empty((t_last - t_first,) + raw_data_mip_bff.shape[1:], dtype=raw_data_mip_bff.dtype)
+        raw_data[t_start - t_first:t_end - t_first]      =  raw_data_bff                                  # each piece goes in its place of the analysed stack
+        raw_data_mip[t_start - t_first:t_end - t_first]  =  raw_data_mip_bff
+
+    return raw_data, raw_data_mip
+
+
+def mip_matching_frames(analysis_folder, fnames, ch_numb, crop_roi, pre_nopre_flag, pbar):
+    """Find the analysed frames searching the first and last saved mip frames in the files (analysis folders without provenance)."""
+    first_frame  =  np.load(analysis_folder + '/first_mip_frame.npy')                                    # load the first analyzed raw frame
+    last_frame   =  np.load(analysis_folder + '/last_mip_frame.npy')                                     # load the last analyzed raw frame
+    raw_data     =  None
+
+    for cnt, fname in enumerate(fnames):
+        pbar.update_progressbar1(cnt)
+        raw_data, raw_data_mip  =  RawDataCache.load_czi_file(fname, ch_numb, pre_nopre_flag, smooth_dtype=np.float64)      # get image and mip (presmoothed as in the first versions, to find the saved frames), decoded or from the cache
+
+        raw_data_mip  =  raw_data_mip[:, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]            # crop mip matrix accodringly with crop info
+        raw_data      =  raw_data[:, :, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]             # crop raw matrix accodringly with crop info
+
+        uu_first  =  np.sum(np.abs(raw_data_mip - first_frame), axis=(1, 2))                          # subtract 'first_frame' from all the images of the mip stack and then sum in x-y to find the first analyzed frame
+        if uu_first.min() == 0:                                                                       # if the min is equal to 0, the first analyzed frame is in the loaded data, otherwise go on with the other file overwriting
+            first_fr      =  np.where(uu_first == 0)[0][0]                                            # check the frame number corresponding to the first analyzed frame
+            raw_data      =  raw_data[first_fr:]                                                      # cut properly 4d raw data
+            raw_data_mip  =  raw_data_mip[first_fr:]                                                  # cut properly mip raw data
+            fname2st      =  cnt                                                                      # store the position in the fnames list of the file
+            break                                                                                     # get out of the for loop
+
+    uu_last  =  np.sum(np.abs(raw_data_mip - last_frame), axis=(1, 2))
+    if uu_last.min() == 0:                                                                            # if the last analyzed frame is in the same file
+        last_fr       =  np.where(uu_last == 0)[0][0]                                                 # find the coordinate of the last analyzed frame
+        raw_data      =  raw_data[:last_fr + 1]                                                       # cut properly the 4d raw data
+        raw_data_mip  =  raw_data_mip[:last_fr + 1]                                                   # cut properly the mip raw data
+
+    else:                                                                                             # the last analyzed frame is not in the same file: go on loading the following files
+        raw_data_pcs  =  [raw_data]                                                                 # pieces of the files are joined only once at the end
+        mip_pcs       =  [raw_data_mip]
+        for ff in fnames[fname2st + 1:]:                                                            # starting from the file following the one with the first analyzed frame
+            cnt                             +=  1
+            pbar.update_progressbar1(cnt)
+            raw_data_bff, raw_data_mip_bff  =  RawDataCache.load_czi_file(ff, ch_numb, pre_nopre_flag, smooth_dtype=np.float64)     # get image and mip (presmoothed if needed)
+
+            raw_data_mip_bff  =  raw_data_mip_bff[:, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]    # crop mip matrix accodringly with crop info
+            raw_data_bff      =  raw_data_bff[:, :, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]     # crop raw matrix accodringly with crop info
+
+            uu_last  =  np.sum(np.abs(raw_data_mip_bff - last_frame), axis=(1, 2))                        # subtract 'last_frame' from all the images of the mip stack and then sum in x-y to find the first analyzed frame
+            if uu_last.min() == 0:                                                                        # if the last analyzed frame is in the loaded file
+                last_fr           =  np.where(uu_last == 0)[0][0]                                         # search its coordinate
+                raw_data_pcs.append(raw_data_bff[:last_fr + 1])                                           # properly cut the 4d raw data
+                mip_pcs.append(raw_data_mip_bff[:last_fr + 1])                                            # properly cut the mip raw data
+                break                                                                                     # get out of the loop
+            else:                                                                                         # if the last analyzed frame is not there, just store and go on
+                raw_data_pcs.append(raw_data_bff)
+                mip_pcs.append(raw_data_mip_bff)
+
+        raw_data      =  np.concatenate(raw_data_pcs, axis=0)                                              # concatenate 4d
+        raw_data_mip  =  np.concatenate(mip_pcs, axis=0)                                                   # concatenate mip
+
+    return raw_data, raw_data_mip
 
 
 class RawData:
     """Load and concatenate .czi files."""
     def __init__(self, analysis_folder, fnames):
 
-        first_fr  =  None
-        last_fr   =  None
-        raw_data  =  None
-
         # err_msg         =  QtWidgets.QMessageBox()
-        first_frame     =  np.load(analysis_folder + '/first_mip_frame.npy')                                               # load the first analyzed raw frame
-        last_frame      =  np.load(analysis_folder + '/last_mip_frame.npy')                                                # load the last analyzed raw frame
         ch_numb         =  np.load(analysis_folder + '/ch_numb.npy')                                                       # load channels number
         crop_roi        =  np.load(analysis_folder + '/crop_roi.npy')                                                      # load crop corners coordinates
         pre_nopre_flag  =  np.load(analysis_folder + '/pre_nopre_flag.npy')                                                # load presmoothing / no-presmoothing flag
+        provenance      =  None
+        if os.path.isfile(analysis_folder + '/raw_provenance.npz'):                                                        # files list, frames of each file and analysed time window
+            provenance  =  dict(np.load(analysis_folder + '/raw_provenance.npz'))
+            if provenance['fnames'].tolist() != [fname[fname.rfind('/') + 1:] for fname in fnames]:
+                provenance  =  None                                                                                         # not the files of the analysis: search the frames as for the old analysis
 
         pbar  =  ServiceWidgets.ProgressBar(total1=len(fnames))
         pbar.show()
         pbar.update_progressbar1(1)
 
-        for cnt, fname in enumerate(fnames):
-            img       =  AICSImage(fname)                                          # read and load file
-            pbar.update_progressbar1(cnt)
-            raw_data  =  img.get_image_data("TZXY", C=ch_numb)                     # get image
-            if pre_nopre_flag:                                                     # if presmoothing is required
-                for tt in range(raw_data.shape[0]):                                # frame by frame
-                    bff           =  gaussian(raw_data[tt], 1.5)                   # gaussian fitting with a fixed kernel of 1.5
-                    raw_data[tt]  =  (bff * 1000).astype(np.uint16)                # since gaussian smoothing gives real values in [0, 1] we just fix this problem
-
-            raw_data_mip  =  np.zeros((img.dims.T, img.dims.X, img.dims.Y), dtype=raw_data.dtype)   # initialize empty matrix for mip
-            for uu in range(img.dims.T):
-                for xx in range(img.dims.X):
-                    raw_data_mip[uu, xx, :]  =  raw_data[uu, :, xx, :].max(0)                               # mip
-
-            raw_data_mip  =  raw_data_mip[:, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]            # crop mip matrix accodringly with crop info
-            raw_data      =  raw_data[:, :, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]             # crop raw matrix accodringly with crop info
-
-            uu_first  =  np.sum(np.abs(raw_data_mip - first_frame), axis=(1, 2))                          # subtract 'first_frame' from all the images of the mip stack and then sum in x-y to find the first analyzed frame
-            if uu_first.min() == 0:                                                                       # if the min is equal to 0, the first analyzed frame is in the loaded data, otherwise go on with the other file overwriting
-                first_fr      =  np.where(uu_first == 0)[0][0]                                            # check the frame number corresponding to the first analyzed frame
-                raw_data      =  raw_data[first_fr:]                                                      # cut properly 4d raw data
-                raw_data_mip  =  raw_data_mip[first_fr:]                                                  # cut properly mip raw data
-                fname2st      =  cnt                                                                      # store the position in the fnames list of the file
-                break                                                                                     # get out of the for loop
-
-        if np.where(np.sum(np.abs(raw_data_mip - last_frame), axis=(1, 2)) == 0)[0].size == 0:          # check if the last analyzed frame is in the same file: if not go on loading the following files
-            for ff in fnames[fname2st + 1:]:                                                            # starting from the file following the one with the first analyzed frame
-                pbar.update_progressbar1(cnt + 1)
-                cnt          +=  1
-                img           =  AICSImage(ff)                                                          # read and load file
-                raw_data_bff  =  img.get_image_data("TZXY", C=ch_numb)                                  # get image
-                if pre_nopre_flag:                                                                      # presmooth if needed
-                    for tt in range(raw_data_bff.shape[0]):
-                        bff               =  gaussian(raw_data_bff[tt], 1.5)
-                        raw_data_bff[tt]  =  (bff * 1000).astype(np.uint16)
-                raw_data_mip_bff  =  np.zeros((img.dims.T, img.dims.X, img.dims.Y), dtype=raw_data_bff.dtype)   # initialize empty matrix for mip
-                for uu in range(img.dims.T):
-                    for xx in range(img.dims.X):
-                        raw_data_mip_bff[uu, xx, :]  =  raw_data_bff[uu, :, xx, :].max(0)                               # mip
-
-                raw_data_mip  =  raw_data_mip[:, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]            # crop mip matrix accodringly with crop info
-                raw_data      =  raw_data[:, :, crop_roi[0]:crop_roi[2], crop_roi[1]:crop_roi[3]]             # crop raw matrix accodringly with crop info
-
-                uu_last  =  np.sum(np.abs(raw_data_mip_bff - last_frame), axis=(1, 2))                        # subtract 'last_frame' from all the images of the mip stack and then sum in x-y to find the first analyzed frame
-                if uu_last.min() == 0:                                                                        # if the last analyzed frame is in the loaded file
-                    last_fr           =  np.where(uu_last == 0)[0][0]                                         # search its coordinate
-                    raw_data_bff      =  raw_data_bff[:last_fr + 1]                                           # properly cut the 4d raw data
-                    raw_data_mip_bff  =  raw_data_mip_bff[:last_fr + 1]                                       # properly cut the mip raw data
-                    raw_data          =  np.concatenate((raw_data, raw_data_bff), axis=0)                     # concatenate 4d
-                    raw_data_mip      =  np.concatenate((raw_data_mip, raw_data_mip_bff), axis=0)             # concatenate mip
-                    break                                                                                     # get out of the loop
-                else:                                                                                         # if the last analyzed frame is not there, just concatenate and go on
-                    raw_data      =  np.concatenate((raw_data, raw_data_bff), axis=0)
-                    raw_data_mip  =  np.concatenate((raw_data_mip, raw_data_mip_bff), axis=0)
-
-        elif np.where(np.sum(np.abs(raw_data_mip - last_frame) == 0))[0].size != 0:                         # if the last analyzed frame is in the same file
-            uu_last           =  np.sum(np.abs(raw_data_mip - last_frame), axis=(1, 2))                     # find the coordinate of the last analyzed frame
-            last_fr           =  np.where(uu_last == 0)[0][0]
-            raw_data_bff      =  raw_data[:last_fr + 1]                                                     # cut properly the 4d raw data
-            raw_data_mip_bff  =  raw_data_mip[:last_fr + 1]                                                 # cut properly the mip raw data
+        if provenance is not None:
+            raw_data, raw_data_mip  =  provenance_frames(provenance, fnames, ch_numb, crop_roi, pre_nopre_flag, pbar)
+        else:
+            raw_data, raw_data_mip  =  mip_matching_frames(analysis_folder, fnames, ch_numb, crop_roi, pre_nopre_flag, pbar)
+
+        pbar.close()
+        img  =  AICSImage(fnames[0])                                                                  # read the metadata of the file
 
         try:
             pix_size_xy  =  img.physical_pixel_sizes.X                                                      # read pixel size
@@ -118,6 +153,9 @@ class RawData:
         self.pix_size_xy      =  pix_size_xy
         self.ch_numb          =  ch_numb
         self.time_step_value  =  time_step_value
+        self.files_tlens      =  None if provenance is None else provenance['files_tlens']
+        self.files_t_offsets  =  None if provenance is None else provenance['files_t_offsets']
+        self.frames_range     =  None if provenance is None else provenance['frames_range'].tolist()
 
 
 class AnalysisParameters:
@@ -141,10 +179,33 @@ class SpotsTracked:
 
 
 class SpotsDetected:
-    """Load detected spots."""
+    """Load detected spots: the spots matrices are rebuilt only when they are used."""
     def __init__(self, analysis_folder):
 
-        self.spots_ints     =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_ints.npy').spts_lbls
-        self.spots_vol      =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_vol.npy').spts_lbls
-        self.spots_2d_lbls  =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_2d_lbls.npy').spts_lbls
-        self.spots_coords   =  np.load(analysis_folder + '/spots_coords.npy')
+        self.analysis_folder  =  analysis_folder
+        self.tlen             =  SaveReadMatrix.SpotsMatrixFrames(analysis_folder, '/spots_2d_lbls.npy').shape[0]        # only the header is read
+        self.spots_coords     =  np.load(analysis_folder + '/spots_coords.npy')
+        self.coords_ptr       =  None
+        if np.all(np.diff(self.spots_coords[:, 0]) >= 0):                                                                  # coordinates are sorted by time frame (last row, with the raw data size, included)
+            self.coords_ptr  =  np.searchsorted(self.spots_coords[:, 0], np.arange(self.tlen + 1))                         # first coordinate of each time frame
+
+    @cached_property
+    def spots_ints(self):
+        """Spots intensity matrix."""
+        return SaveReadMatrix.SpotsMatrixReader(self.analysis_folder, '/spots_ints.npy').spts_lbls
+
+    @cached_property
+    def spots_vol(self):
+        """Spots volume matrix."""
+        return SaveReadMatrix.SpotsMatrixReader(self.analysis_folder, '/spots_vol.npy').spts_lbls
+
+    @cached_property
+    def spots_2d_lbls(self):
+        """Spots 2D labels matrix."""
+        return SaveReadMatrix.SpotsMatrixReader(self.analysis_folder, '/spots_2d_lbls.npy').spts_lbls
+
+    def coords_frame(self, tt):
+        """Coordinates of the spots of the time frame tt."""
+        if self.coords_ptr is None:
+            return self.spots_coords[self.spots_coords[:, 0] == tt]
+        return self.spots_coords[self.coords_ptr[tt]:self.coords_ptr[tt + 1]]
@@ -14,7 +14,7 @@ import SaveReadMatrix
 class AnalysisSaver:
     """Only class, does all the job."""
     def __init__(self, analysis_folder, fnames, raw_data, software_version, spots_3d_det, spots_trckd, merge_radius,
-                 detect_thr, min_volthr_value, dist_thr, spots_features, crop_roi, ch_numb, pre_nopre_flag):
+                 detect_thr, min_volthr_value, dist_thr, spots_features, crop_roi, ch_numb, pre_nopre_flag, g_kern, frames_range=None):
 
         reload(SaveReadMatrix)
 
@@ -29,7 +29,7 @@ class AnalysisSaver:
         sheet8  =  book.add_worksheet("Activations")
 
         sheet1.write(0, 0, "Gauss Kernel")
-        sheet1.write(0, 1, np.load('gauss_kern_size.npy'))
+        sheet1.write(0, 1, g_kern)
         sheet1.write(1, 0, "merge radius")
         sheet1.write(1, 1, merge_radius)
         sheet1.write(2, 0, "detect threshold")
@@ -122,6 +122,9 @@ class AnalysisSaver:
         np.save(analysis_folder + '/ch_numb.npy', ch_numb)
         np.save(analysis_folder + '/first_mip_frame.npy', raw_data.raw_data_mip[0])
         np.save(analysis_folder + '/last_mip_frame.npy', raw_data.raw_data_mip[-1])
+        if frames_range is not None and getattr(raw_data, "files_tlens", None) is not None:                    # provenance of the analysed frames: the loader reads only them, without searching the first and last mip frames
+            np.savez(analysis_folder + '/raw_provenance.npz', fnames=np.array([fname[fname.rfind('/') + 1:] for fname in fnames]), files_tlens=np.asarray(raw_data.files_tlens),
+                     files_t_offsets=np.asarray(raw_data.files_t_offsets), frames_range=np.asarray(frames_range), crop_roi=np.asarray(crop_roi))
         SaveReadMatrix.SpotsMatrixSaver(spots_3d_det.spots_ints, analysis_folder, '/spots_ints.npy')
         SaveReadMatrix.SpotsMatrixSaver(spots_3d_det.spots_vol, analysis_folder, '/spots_vol.npy')
         SaveReadMatrix.SpotsMatrixSaver(spots_3d_det.spots_2d_lbls, analysis_folder, '/spots_2d_lbls.npy')
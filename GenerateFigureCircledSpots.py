@@ -20,7 +20,7 @@ class GenerateFigureCircledSpots:
         img2show[..., 1]  =  raw_data_mip[t_frame]
         img2show[..., 2]  =  raw_data_mip[t_frame]
 
-        spts_trck  =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_trck.npy').spts_lbls[t_frame]   # load segmented spots (2D plus time) and select the time frame in question
+        spts_trck  =  SaveReadMatrix.read_frame(analysis_folder, '/spots_trck.npy', t_frame)                   # load only the time frame in question of the segmented spots (2D plus time)
         rgp        =  regionprops_table(spts_trck, properties=["label", "centroid"])                                    # regionprops of the 2D spots in the frame
         xlen      -=  1
         ylen      -=  1
@@ -19,11 +19,11 @@ class GenerateHullImage:
     def __init__(self, analysis_folder, fnames):
 
         raw_data   =  AnalysisLoader.RawData(analysis_folder, fnames)                                                   # load raw data
-        spts_lbls  =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_2d_lbls.npy').spts_lbls         # load detetcted spots
+        spts_lbls  =  SaveReadMatrix.SpotsMatrixFrames(analysis_folder, '/spots_2d_lbls.npy')                           # detected spots, rebuilt one frame at the time
         tlen       =  spts_lbls.shape[0]                                                                                # number of time frames
-        spts_ctrs  =  np.zeros_like(spts_lbls[0])                                                                       # initialize spots-centroids matrix
+        spts_ctrs  =  np.zeros(spts_lbls.shape[1:], dtype=np.uint32)                                                    # initialize spots-centroids matrix
         for tt in range(tlen):                                                                                          # for each time frame
-            rgp_spts   =  regionprops_table(spts_lbls[tt], properties=["centroid", "label"])                            # regionprops of all the spots
+            rgp_spts   =  regionprops_table(spts_lbls.frame(tt), properties=["centroid", "label"])                      # regionprops of all the spots
             for cnt, kk in enumerate(rgp_spts["centroid-0"]):                                                           # for each spot in the time frame
                 spts_ctrs[int(kk), int(rgp_spts["centroid-1"][cnt])]  =  rgp_spts["label"][cnt]                         # add a point in the centroid position
 
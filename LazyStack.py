@@ -0,0 +1,122 @@
+"""This function gives a lazy view of a stack of raw data frames.
+
+Frames are decoded only when they are asked for (by a frame reader of LoadRawData) and
+the last decoded ones are kept in an LRU cache. Indexing follows numpy: an integer or
+an array on the time axis gives decoded frames, slices give a new lazy view (so chop
+and crop tools do not decode anything) and np.asarray decodes the whole stack.
+Decoded frames are read only, since they are shared with the cache. The size of the
+cache (in MB) is a setting stored in 'lazy_cache_mb.npy': 0 switches lazy loading off.
+"""
+
+import os.path
+from collections import OrderedDict
+import numpy as np
+
+
+LAZY_CACHE_MB  =  0                                                                     # default: raw data are fully loaded
+
+
+def lazy_cache_mb():
+    """Read the size of the decoded frames cache (0 means no lazy loading)."""
+    if os.path.isfile('lazy_cache_mb.npy'):
+        return float(np.load('lazy_cache_mb.npy'))
+    return LAZY_CACHE_MB
+
+
+def range2slice(rng):
+    """Slice equivalent to a range of indexes."""
+    stop  =  rng.stop if rng.stop >= 0 else None                                        # a negative step can stop before 0
+    return slice(rng.start, stop, rng.step)
+
+
+class FramesCache:
+    """LRU cache of the frames decoded by frame_fn."""
+    def __init__(self, frame_fn, frame_nbytes, cache_mb):
+
+        self.frame_fn    =  frame_fn
+        self.max_frames  =  max(1, int(cache_mb * 2 ** 20 // max(frame_nbytes, 1)))
+        self.frames      =  OrderedDict()
+
+    def get(self, t):
+        """Frame t, from the cache or decoded."""
+        if t in self.frames:
+            self.frames.move_to_end(t)
+            return self.frames[t]
+        frame                  =  np.asarray(self.frame_fn(t))
+        frame.flags.writeable  =  False
+        self.frames[t]         =  frame
+        if len(self.frames) > self.max_frames:
+            self.frames.popitem(last=False)                                             # drop the least recently used frame
+        return frame
+
+
+class LazyStack:
+    """Stack of frames decoded on demand, with the attributes of a numpy array."""
+    def __init__(self, frame_fn, tlen, frame_shape, dtype, cache_mb=None, frames_cache=None, t_idxs=None, frame_rngs=None):
+
+        self.dtype  =  np.dtype(dtype)
+        if frames_cache is None:
+            cache_mb      =  lazy_cache_mb() if cache_mb is None else cache_mb
+            frames_cache  =  FramesCache(frame_fn, int(np.prod(frame_shape)) * self.dtype.itemsize, cache_mb)
+
+        self.frames_cache  =  frames_cache                                                                  # views of the same stack share the cache
+        self.t_idxs        =  np.arange(tlen) if t_idxs is None else t_idxs                                 # frames of the source in this view
+        self.frame_rngs    =  [range(k) for k in frame_shape] if frame_rngs is None else frame_rngs          # crop of the frames in this view
+
+    @property
+    def shape(self):
+        """Shape of the stack."""
+        return (self.t_idxs.size,) + tuple(len(rng) for rng in self.frame_rngs)
+
+    @property
+    def ndim(self):
+        """Number of dimensions."""
+        return len(self.frame_rngs) + 1
+
+    @property
+    def size(self):
+        """Number of elements."""
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.t_idxs.size
+
+    def frame(self, t):
+        """Decoded frame t of the view."""
+        return self.frames_cache.get(int(self.t_idxs[t]))[tuple(range2slice(rng) for rng in self.frame_rngs)]
+
+    def __getitem__(self, key):
+        key  =  key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            ell  =  key.index(Ellipsis)
+            key  =  key[:ell] + (slice(None),) * (self.ndim - len(key) + 1) + key[ell + 1:]
+        t_key, fr_key  =  key[0], key[1:]
+
+        if isinstance(t_key, (int, np.integer)):
+            return self.frame(t_key)[fr_key]
+
+        if isinstance(t_key, slice) and all(isinstance(k, slice) for k in fr_key):                          # basic indexing: a new lazy view, nothing is decoded
+            frame_rngs  =  [rng[k] for rng, k in zip(self.frame_rngs, fr_key)] + self.frame_rngs[len(fr_key):]
+            return LazyStack(None, None, None, self.dtype, frames_cache=self.frames_cache, t_idxs=self.t_idxs[t_key], frame_rngs=frame_rngs)
+
+        t_idxs  =  np.arange(len(self))[t_key]                                                              # fancy indexing: frames are decoded
+        out     =  np.empty((t_idxs.size,) + self.shape[1:], dtype=self.dtype)
+        for cnt, t in enumerate(t_idxs):
+            out[cnt]  =  self.frame(t)
+        return out[(slice(None),) + fr_key]
+
+    def __array__(self, dtype=None, copy=None):
+        out  =  self[np.arange(len(self))]
+        return out if dtype is None else out.astype(dtype)
+
+    def max(self, axis=None):
+        """Maximum, frame by frame if no axis is given."""
+        if axis is None:
+            return max(self.frame(t).max() for t in range(len(self)))
+        return np.asarray(self).max(axis)
+
+    def min(self, axis=None):
+        """Minimum, frame by frame if no axis is given."""
+        if axis is None:
+            return min(self.frame(t).min() for t in range(len(self)))
+        return np.asarray(self).min(axis)
@@ -3,21 +3,87 @@ Loaded matrix is fliped and rotate to adapt to ImageJ visualization.
 
 Input is a file path, output is a TxZxXxY file.
 There is only one channel.
+With mmap_path (see temp_stack_path) the stack is stored in a memory mapped .npy file
+that the detection workers map themselves, so frames are never sent to them.
 """
 
+import os
+import shutil
+import tempfile
 from importlib import reload
 import numpy as np
 from aicsimageio import AICSImage
 import tifffile
 import czifile
-from skimage.filters import gaussian
 
 import ServiceWidgets
+import RawDataProjections
+import RawDataCache
+import LazyStack
+import Presmoothing
+import SharedArrays
+
+
+def czi_stack_shape(fnames):
+    """Read only the metadata of the files: number of time frames of each file, z-x-y shape of the frames and dtype."""
+    tlens  =  []
+    for fname in fnames:
+        img  =  AICSImage(fname)
+        tlens.append(img.dims.T)
+    return tlens, (img.dims.Z, img.dims.X, img.dims.Y), img.dtype
+
+
+def tiff_stack_shape(fnames):
+    """Read only the metadata of the tiff files: shape of each file (without the singleton dimensions) and dtype."""
+    shapes  =  []
+    for fname in fnames:
+        with tifffile.TiffFile(fname) as tif:
+            shapes.append(tuple(k for k in tif.series[0].shape if k != 1))
+            raw_dtype  =  tif.series[0].dtype
+    return shapes, raw_dtype
+
+
+def files_t_offsets(tlens):
+    """Position of the first frame of each file in the concatenated stack: files are concatenated from the last to the first."""
+    return [int(sum(tlens[cn + 1:])) for cn in range(len(tlens))]
+
+
+def temp_stack_path():
+    """Path of a new temporary .npy file to store a stack shared with the workers."""
+    fd, mmap_path  =  tempfile.mkstemp(prefix="OptoTrack_stack_", suffix=".npy")
+    os.close(fd)
+    return mmap_path
+
+
+def remove_stack_file(mmap_path):
+    """Remove a temporary stack file (on Windows a file still mapped can not be removed: it stays in the temp folder)."""
+    if mmap_path is not None and os.path.isfile(mmap_path):
+        try:
+            os.remove(mmap_path)
+        except OSError:
+            pass
+
+
+def empty_stack(shape, dtype, mmap_path=None):
+    """Preallocate the whole 4D matrix once: in memory, or as a memory mapped .npy file if mmap_path is given and its disk has room for it."""
+    nbytes  =  int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if mmap_path is None or shutil.disk_usage(os.path.dirname(os.path.abspath(mmap_path))).free < nbytes + 2 ** 20:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
+
+
+def shareable_stack(raw_data, mmap_path=None):
+    """The stack as it is if the workers can already map it (or without mmap_path), otherwise copied in the memory mapped file mmap_path."""
+    if mmap_path is None or SharedArrays.mmap_desc(raw_data) is not None:
+        return raw_data
+    stack     =  empty_stack(raw_data.shape, raw_data.dtype, mmap_path)
+    stack[:]  =  raw_data
+    return stack
 
 
 class LoadRawDataCzi:
     """Load and concatenate .czi files."""
-    def __init__(self, fnames, ch_numb=-1):
+    def __init__(self, fnames, ch_numb=-1, mmap_path=None):
 
         reload(ServiceWidgets)
         img  =  AICSImage(fnames[0])                                                               # read and load file
@@ -43,29 +109,26 @@ class LoadRawDataCzi:
             else:
                 ch_numb  =  0                                                                       # only one channel, work on the channel 0
 
-        raw_data  =  img.get_image_data("TZXY", C=ch_numb)                     # get image
-
         pbar  =  ServiceWidgets.ProgressBar(total1=len(fnames))
         pbar.show()
         pbar.update_progressbar1(1)
 
-        raw_data_mip  =  np.zeros((img.dims.T, img.dims.X, img.dims.Y), dtype=raw_data.dtype)   # initialize empty matrix for mip
-        for uu in range(img.dims.T):
-            for xx in range(img.dims.X):
-                raw_data_mip[uu, xx, :]  =  raw_data[uu, :, xx, :].max(0)                               # mip
-
-        for cn, fname in enumerate(fnames[1:]):                                                         # for all the other file (if any) repeat the same operations
-            pbar.update_progressbar1(cn + 1)
-            img_bff       =  AICSImage(fname)
-            raw_data_bff  =  img_bff.get_image_data("TZXY", C=ch_numb)
+        if len(fnames) == 1:
+            raw_data, raw_data_mip  =  RawDataCache.load_czi_file(fnames[0], ch_numb)                  # a single file is used as it is (memory mapped if it comes from the cache)
+            raw_data                =  shareable_stack(raw_data, mmap_path)
+            tlens                   =  [raw_data.shape[0]]
 
-            raw_data_bff_mip  =  np.zeros((img_bff.dims.T, img_bff.dims.X, img_bff.dims.Y), dtype=raw_data.dtype)
-            for uu in range(img_bff.dims.T):
-                for xx in range(img_bff.dims.X):
-                    raw_data_bff_mip[uu, xx, :]  =  raw_data_bff[uu, :, xx, :].max(0)
+        else:
+            tlens, (zlen, xlen, ylen), raw_dtype  =  czi_stack_shape(fnames)                       # first read the size of all the files, then fill the preallocated matrices
+            t_offs                                 =  files_t_offsets(tlens)
+            raw_data                               =  empty_stack((sum(tlens), zlen, xlen, ylen), raw_dtype, mmap_path)
+            raw_data_mip                           =  np.empty((sum(tlens), xlen, ylen), dtype=raw_dtype)
 
-            raw_data      =  np.concatenate((raw_data_bff, raw_data), axis=0)
-            raw_data_mip  =  np.concatenate((raw_data_bff_mip, raw_data_mip), axis=0)
+            files_nbytes                           =  [tlen * zlen * xlen * ylen * np.dtype(raw_dtype).itemsize for tlen in tlens]
+            for cn, file_raw, file_mip in RawDataCache.iter_czi_files(fnames, ch_numb, files_nbytes=files_nbytes):     # get image and its mip (decoded or from the cache), the next files are decoded meanwhile
+                pbar.update_progressbar1(cn + 1)
+                t_sl                                =  slice(t_offs[cn], t_offs[cn] + tlens[cn])        # place of the file in the concatenated stack
+                raw_data[t_sl], raw_data_mip[t_sl]  =  file_raw, file_mip
 
         pbar.close()
 
@@ -75,11 +138,18 @@ class LoadRawDataCzi:
         self.pix_size_xy      =  pix_size_xy
         self.ch_numb          =  ch_numb
         self.time_step_value  =  time_step_value
+        self.files_tlens      =  tlens                                                     # number of time frames of each file and position of each file in the stack: the provenance of the frames saved with the analysis
+        self.files_t_offsets  =  files_t_offsets(tlens)
+        self.mmap_path        =  mmap_path                                                 # temporary file of the stack (removed by close)
+
+    def close(self):
+        """Remove the temporary file of the stack, if any: to call when the data are replaced."""
+        remove_stack_file(self.mmap_path)
 
 
 class LoadRawDataCziPresmooth:
     """Load and concatenate .czi files as in the previous class, but with a smoothing."""
-    def __init__(self, fnames, ch_numb=-1):
+    def __init__(self, fnames, ch_numb=-1, mmap_path=None):
 
         reload(ServiceWidgets)
         img  =  AICSImage(fnames[0])
@@ -108,31 +178,22 @@ class LoadRawDataCziPresmooth:
         pbar.show()
         pbar.update_progressbar1(1)
 
-        raw_data  =  img.get_image_data("TZXY", C=ch_numb)
-        for tt in range(raw_data.shape[0]):
-            bff           =  gaussian(raw_data[tt], 1.5)
-            raw_data[tt]  =  (bff * 1000).astype(np.uint16)
+        if len(fnames) == 1:
+            raw_data, raw_data_mip  =  RawDataCache.load_czi_file(fnames[0], ch_numb, presmooth_flag=True)
+            raw_data                =  shareable_stack(raw_data, mmap_path)
+            tlens                   =  [raw_data.shape[0]]
 
-        raw_data_mip  =  np.zeros((img.dims.T, img.dims.X, img.dims.Y), dtype=raw_data.dtype)
-        for uu in range(img.dims.T):
-            for xx in range(img.dims.X):
-                raw_data_mip[uu, xx, :]  =  raw_data[uu, :, xx, :].max(0)
+        else:
+            tlens, (zlen, xlen, ylen), raw_dtype  =  czi_stack_shape(fnames)
+            t_offs                                 =  files_t_offsets(tlens)
+            raw_data                               =  empty_stack((sum(tlens), zlen, xlen, ylen), raw_dtype, mmap_path)
+            raw_data_mip                           =  np.empty((sum(tlens), xlen, ylen), dtype=raw_dtype)
 
-        for cn, fname in enumerate(fnames[1:]):
-            pbar.update_progressbar1(cn + 1)
-            img_bff       =  AICSImage(fname)
-            raw_data_bff  =  img_bff.get_image_data("TZXY", C=ch_numb)
-
-            for tt in range(img_bff.dims.T):
-                raw_data_bff[tt]  =  (1000 * gaussian(raw_data_bff[tt], 1.5)).astype(np.uint16)
-
-            raw_data_bff_mip  =  np.zeros((img_bff.dims.T, img_bff.dims.X, img_bff.dims.Y), dtype=raw_data.dtype)
-            for uu in range(img_bff.dims.T):
-                for xx in range(img_bff.dims.X):
-                    raw_data_bff_mip[uu, xx, :]  =  raw_data_bff[uu, :, xx, :].max(0)
-
-            raw_data      =  np.concatenate((raw_data_bff, raw_data), axis=0)
-            raw_data_mip  =  np.concatenate((raw_data_bff_mip, raw_data_mip), axis=0)
+            files_nbytes                           =  [tlen * zlen * xlen * ylen * np.dtype(raw_dtype).itemsize for tlen in tlens]
+            for cn, file_raw, file_mip in RawDataCache.iter_czi_files(fnames, ch_numb, presmooth_flag=True, files_nbytes=files_nbytes):
+                pbar.update_progressbar1(cn + 1)
+                t_sl                                =  slice(t_offs[cn], t_offs[cn] + tlens[cn])
+                raw_data[t_sl], raw_data_mip[t_sl]  =  file_raw, file_mip
 
         pbar.close()
 
@@ -142,42 +203,205 @@ class LoadRawDataCziPresmooth:
         self.pix_size_xy      =  pix_size_xy
         self.ch_numb          =  ch_numb
         self.time_step_value  =  time_step_value
+        self.files_tlens      =  tlens                                                     # number of time frames of each file and position of each file in the stack: the provenance of the frames saved with the analysis
+        self.files_t_offsets  =  files_t_offsets(tlens)
+        self.mmap_path        =  mmap_path                                                 # temporary file of the stack (removed by close)
+
+    def close(self):
+        """Remove the temporary file of the stack, if any: to call when the data are replaced."""
+        remove_stack_file(self.mmap_path)
+
+
+class CziFramesReader:
+    """Read .czi files one time frame at the time, without loading the whole 4D stack in memory."""
+    def __init__(self, fnames, ch_numb=0, presmooth_flag=False):
+
+        tlens, frame_shape, raw_dtype  =  czi_stack_shape(fnames)                          # only metadata are read here
+
+        self.fnames          =  fnames
+        self.ch_numb         =  ch_numb
+        self.presmooth_flag  =  presmooth_flag
+        self.tlen            =  sum(tlens)
+        self.frame_shape     =  frame_shape
+        self.dtype           =  np.dtype(np.uint16) if presmooth_flag else np.dtype(raw_dtype)
+        self.tlens           =  tlens
+        self.t_offs          =  files_t_offsets(tlens)
+        self.imgs            =  {}
+
+    def frame(self, t):
+        """Decode only the time frame t of the concatenated stack."""
+        cn  =  [k for k in range(len(self.fnames)) if self.t_offs[k] <= t < self.t_offs[k] + self.tlens[k]][0]     # file of the frame
+        if cn not in self.imgs:
+            self.imgs[cn]  =  AICSImage(self.fnames[cn])
+        frame  =  self.imgs[cn].get_image_dask_data("ZXY", T=t - self.t_offs[cn], C=self.ch_numb).compute()
+        if self.presmooth_flag:
+            frame  =  Presmoothing.presmooth_frame(frame)
+        return frame
+
+    def close(self):
+        """Release the opened files: they are opened again if more frames are read."""
+        self.imgs  =  {}
+
+    def frames(self):
+        """Generator of the 3D frames, in the same order of LoadRawDataCzi (last file first)."""
+        for fname in self.fnames[::-1]:
+            img  =  AICSImage(fname)
+            for tt in range(img.dims.T):
+                frame  =  img.get_image_dask_data("ZXY", T=tt, C=self.ch_numb).compute()     # decode only this time frame
+                if self.presmooth_flag:
+                    frame  =  Presmoothing.presmooth_frame(frame)
+                yield frame
+
+
+class TiffFramesReader:
+    """Read tiff files one time frame at the time, reading only the pages of the frame."""
+    def __init__(self, fnames, ch_numb=0):
+
+        self.fnames   =  fnames
+        self.tifs     =  [tifffile.TiffFile(fname) for fname in fnames]                              # file handles stay open until close()
+        self.ch_numb  =  ch_numb
+        page_shapes   =  [tif.series[0].shape[:-2] for tif in self.tifs]                              # every page is a y-x plane
+        self.dtype    =  np.dtype(self.tifs[0].series[0].dtype)
+
+        self.pages_dims  =  []                                                                         # positions of time, z and channel among the pages dimensions
+        for page_shape in page_shapes:
+            dims  =  [k for k in range(len(page_shape)) if page_shape[k] != 1]
+            if len(dims) > 2:
+                pos_ch  =  dims[np.argmin([page_shape[k] for k in dims])]                               # as in LoadRawDataTiff, channel is the shortest dimension
+                dims.remove(pos_ch)
+                dims.append(pos_ch)
+            self.pages_dims.append(dims)
+
+        self.page_shapes  =  page_shapes
+        self.tlens        =  [page_shape[dims[0]] for page_shape, dims in zip(page_shapes, self.pages_dims)]
+        self.t_offs       =  files_t_offsets(self.tlens)
+        self.tlen         =  sum(self.tlens)
+        zlen              =  page_shapes[0][self.pages_dims[0][1]]
+        ylen, xlen        =  self.tifs[0].series[0].shape[-2:]
+        self.frame_shape  =  (zlen, xlen, ylen)
+
+    def frame(self, t):
+        """Read only the pages of the time frame t of the concatenated stack."""
+        cn        =  [k for k in range(len(self.tifs)) if self.t_offs[k] <= t < self.t_offs[k] + self.tlens[k]][0]
+        dims      =  self.pages_dims[cn]
+        page_idx  =  np.zeros((len(self.page_shapes[cn]), self.frame_shape[0]), dtype=np.int64)
+        page_idx[dims[0]]  =  t - self.t_offs[cn]
+        page_idx[dims[1]]  =  np.arange(self.frame_shape[0])
+        if len(dims) > 2:
+            page_idx[dims[2]]  =  self.ch_numb
+        if self.tifs[cn] is None:
+            self.tifs[cn]  =  tifffile.TiffFile(self.fnames[cn])                                    # closed before: open it again
+        pages  =  self.tifs[cn].asarray(key=np.ravel_multi_index(page_idx, self.page_shapes[cn]).tolist(), series=0).reshape(self.frame_shape[0], self.frame_shape[2], self.frame_shape[1])
+        return pages.transpose(0, 2, 1)                                                           # same orientation as LoadRawDataTiff
+
+    def close(self):
+        """Close the file handles: they are opened again if more frames are read."""
+        for cn, tif in enumerate(self.tifs):
+            if tif is not None:
+                tif.close()
+                self.tifs[cn]  =  None
+
+
+class LoadRawDataCziLazy:
+    """Open .czi files without decoding them: frames are decoded when they are used."""
+    def __init__(self, fnames, ch_numb=-1, presmooth_flag=False, cache_mb=None):
+
+        reload(ServiceWidgets)
+        img  =  AICSImage(fnames[0])
+        try:
+            pix_size_xy  =  img.physical_pixel_sizes.X
+            pix_size_z   =  img.physical_pixel_sizes.Z
+        except:
+            pix_size_xy, pix_size_z  =  ServiceWidgets.InputPixSize.get_vals()
+
+        with czifile.CziFile(str(fnames[0])) as czi:
+            for attachment in czi.attachments():
+                if attachment.attachment_entry.name == 'TimeStamps':
+                    timestamps  =  attachment.data()
+                    break
+            else:
+                raise ValueError('TimeStamps not found')
+        time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)  # time step value
+
+        if ch_numb == -1:
+            if img.dims.C > 1:
+                ch_numb   =  ServiceWidgets.ChannelNumber.getNumb(img.channel_names) - 1
+            else:
+                ch_numb  =  0
+
+        reader  =  CziFramesReader(fnames, ch_numb, presmooth_flag)
+        self.raw_data, self.raw_data_mip  =  lazy_stacks(reader, cache_mb)
+        self.reader                       =  reader
+
+        self.pix_size_z       =  pix_size_z
+        self.pix_size_xy      =  pix_size_xy
+        self.ch_numb          =  ch_numb
+        self.time_step_value  =  time_step_value
+        self.files_tlens      =  reader.tlens
+        self.files_t_offsets  =  reader.t_offs
+
+    def close(self):
+        """Release the files opened by the frames reader."""
+        self.reader.close()
+
+
+class LoadRawDataTiffLazy:
+    """Open tiff files without reading them: frames are read when they are used."""
+    def __init__(self, fnames, ch_numb=-1, cache_mb=None):
+
+        shapes, _  =  tiff_stack_shape(fnames)
+        if len(shapes[0]) > 4 and ch_numb == -1:
+            ch_numb  =  ServiceWidgets.ChannelNumber.getNumb()
+
+        reader  =  TiffFramesReader(fnames, ch_numb)
+        self.raw_data, self.raw_data_mip  =  lazy_stacks(reader, cache_mb)
+        self.reader                       =  reader
+
+        pix_size_xy, pix_size_z  =  ServiceWidgets.InputPixSize.get_vals()
+
+        self.pix_size_z       =  pix_size_z
+        self.pix_size_xy      =  pix_size_xy
+        self.ch_numb          =  ch_numb
+        self.files_tlens      =  reader.tlens
+        self.files_t_offsets  =  reader.t_offs
+
+    def close(self):
+        """Close the tiff files opened by the frames reader."""
+        self.reader.close()
+
+
+def lazy_stacks(reader, cache_mb=None):
+    """Lazy 4D stack and lazy MIP of the frames given by a frames reader: the MIP of a frame is computed when the frame is decoded and kept."""
+    raw_data      =  LazyStack.LazyStack(reader.frame, reader.tlen, reader.frame_shape, reader.dtype, cache_mb)
+    mip_shape     =  reader.frame_shape[1:]
+    raw_data_mip  =  LazyStack.LazyStack(lambda t: raw_data.frames_cache.get(t).max(axis=0), reader.tlen, mip_shape, reader.dtype, cache_mb=reader.tlen * np.prod(mip_shape) * reader.dtype.itemsize / 2 ** 20 + 1)
+    return raw_data, raw_data_mip
 
 
 class LoadRawDataTiff:
     """Load tiff files."""
-    def __init__(self, fnames, ch_numb=-1):
+    def __init__(self, fnames, ch_numb=-1, mmap_path=None):
 
-        pos_ch   =  None
-        ch_numb  =  None
+        pos_ch  =  None
 
-        raw_data_bff  =  np.squeeze(tifffile.imread(fnames[0]))
-        if len(raw_data_bff.shape) > 4:
+        shapes, raw_dtype  =  tiff_stack_shape(fnames)                                             # first read the size of all the files, then fill the preallocated matrices
+        if len(shapes[0]) > 4:
             if ch_numb == -1:
                 ch_numb  =  ServiceWidgets.ChannelNumber.getNumb()
-            pos_ch   =  np.argmin(np.asarray(raw_data_bff.shape))
-            if pos_ch == 0:
-                raw_data_bff  =  raw_data_bff[ch_numb]
-            elif pos_ch == 1:
-                raw_data_bff  =  raw_data_bff[:, ch_numb]
-            elif pos_ch == 2:
-                raw_data_bff  =  raw_data_bff[:, :, ch_numb]
-
-        tlen, zlen, ylen, xlen  =  raw_data_bff.shape
-        raw_data                =  np.zeros((tlen, zlen, xlen, ylen))
-        for tt in range(tlen):
-            raw_data[tt]  =  np.rot90(raw_data_bff[tt, :, :, ::-1], axes=(1, 2))
+            pos_ch   =  np.argmin(np.asarray(shapes[0]))
+            shapes   =  [shp[:pos_ch] + shp[pos_ch + 1:] for shp in shapes]
+
+        tlens                   =  [shp[0] for shp in shapes]
+        t_offs                  =  files_t_offsets(tlens)
+        zlen, ylen, xlen        =  shapes[0][1:]
+        raw_data                =  empty_stack((sum(tlens), zlen, xlen, ylen), raw_dtype, mmap_path)                 # native dtype of the files
+        raw_data_mip            =  np.empty((sum(tlens), xlen, ylen), dtype=raw_dtype)
 
         pbar  =  ServiceWidgets.ProgressBar(total1=len(fnames))
         pbar.show()
         pbar.update_progressbar1(1)
 
-        raw_data_mip  =  np.zeros((tlen, xlen, ylen), dtype=raw_data_bff.dtype)
-        for uu in range(tlen):
-            for xx in range(xlen):
-                raw_data_mip[uu, xx, :]  =  raw_data[uu, :, xx, :].max(0)
-
-        for cn, fname in enumerate(fnames[1:]):
+        for cn, fname in enumerate(fnames):
             pbar.update_progressbar1(cn + 1)
             raw_data_bff  =  np.squeeze(tifffile.imread(fname))
             if len(raw_data_bff.shape) > 4:
@@ -188,23 +412,23 @@ class LoadRawDataTiff:
                 elif pos_ch == 2:
                     raw_data_bff  =  raw_data_bff[:, :, ch_numb]
 
-            raw_data_bff2  =  np.zeros((tlen, zlen, xlen, ylen), dtype=raw_data_bff.dtype)
-            for tt in range(tlen):
-                raw_data_bff2[tt]  =  np.rot90(raw_data_bff[tt, :, :, ::-1], axes=(1, 2))
-
-            raw_data_bff_mip  =  np.zeros((tlen, xlen, ylen))
-            for uu in range(tlen):
-                for xx in range(xlen):
-                    raw_data_bff_mip[uu, xx, :]  =  raw_data_bff2[uu, :, xx, :].max(0)
-
-            raw_data      =  np.concatenate((raw_data_bff2, raw_data), axis=0)
-            raw_data_mip  =  np.concatenate((raw_data_bff_mip, raw_data_mip), axis=0)
+            t_sl                =  slice(t_offs[cn], t_offs[cn] + tlens[cn])
+            raw_data[t_sl]      =  raw_data_bff.transpose(0, 1, 3, 2)                                  # flip of y and rotation of 90 degrees in x-y are just a swap of x and y: one strided copy
+            raw_data_mip[t_sl]  =  RawDataProjections.mip(raw_data[t_sl])
 
         pbar.close()
 
         pix_size_xy, pix_size_z  =  ServiceWidgets.InputPixSize.get_vals()
 
-        self.raw_data      =  raw_data
-        self.raw_data_mip  =  raw_data_mip
-        self.pix_size_z    =  pix_size_z
-        self.pix_size_xy   =  pix_size_xy
+        self.raw_data         =  raw_data
+        self.raw_data_mip     =  raw_data_mip
+        self.pix_size_z       =  pix_size_z
+        self.pix_size_xy      =  pix_size_xy
+        self.ch_numb          =  ch_numb
+        self.files_tlens      =  tlens
+        self.files_t_offsets  =  t_offs
+        self.mmap_path        =  mmap_path                                                 # temporary file of the stack (removed by close)
+
+    def close(self):
+        """Remove the temporary file of the stack, if any: to call when the data are replaced."""
+        remove_stack_file(self.mmap_path)
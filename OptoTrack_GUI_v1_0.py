@@ -30,10 +30,21 @@ import PhotoBleachingEstimate
 import GenerateFigureCircledSpots
 import SaveReadMatrix
 import ServiceWidgets
+import WorkersPool
+import RawDataCache
+import LazyStack
 # import SegmentNucsClstr
 import GenerateHullImage
 
 
+class LazyImageView(pg.ImageView):
+    """ImageView that can show a LazyStack: the levels come from the current frame only, while the subsampling of ImageView would decode a large part of the stack."""
+    def quickMinMax(self, data):
+        if isinstance(data, LazyStack.LazyStack):
+            return super().quickMinMax(data.frame(min(getattr(self, "currentIndex", 0), len(data) - 1)))
+        return super().quickMinMax(data)
+
+
 class MainWindow(QtWidgets.QMainWindow):
     """Main windows: coordinates all the actions, algorithms, visualization tools and analysis tools."""
     def __init__(self, parent=None):
@@ -149,7 +160,7 @@ class MainWindow(QtWidgets.QMainWindow):
         bottom_labels_box.addWidget(pixsize_z_lbl)
         bottom_labels_box.addWidget(time_step_lbl)
 
-        frame_raw_mip  =  pg.ImageView(self, name="RawMip")
+        frame_raw_mip  =  LazyImageView(self, name="RawMip")
         frame_raw_mip.ui.roiBtn.hide()
         frame_raw_mip.ui.menuBtn.hide()
         frame_raw_mip.view.setXLink("SegmMip")
@@ -314,10 +325,17 @@ class MainWindow(QtWidgets.QMainWindow):
         reply     =  QtWidgets.QMessageBox.question(self, 'Message', quit_msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
 
         if reply == QtWidgets.QMessageBox.Yes:
+            WorkersPool.close_pool()
+            self.close_raw_data()
             event.accept()
         else:
             event.ignore()
 
+    def close_raw_data(self):
+        """Release the files of the raw data (kept open by the lazy loading, or the temporary stack file), before they are replaced."""
+        if hasattr(self, "raw_data") and hasattr(self.raw_data, "close"):
+            self.raw_data.close()
+
     def busy_indicator(self):
         """Write a red text (BUSY) as a label on the GUI (bottom left)."""
         self.busy_lbl.setText("Busy")
@@ -402,7 +420,8 @@ class MainWindow(QtWidgets.QMainWindow):
         """Input results of chop tool."""
         self.raw_data.raw_data_mip  =  self.raw_data.raw_data_mip[self.mpp3.first_last_frame[0]:self.mpp3.first_last_frame[1]]
         self.raw_data.raw_data      =  self.raw_data.raw_data[self.mpp3.first_last_frame[0]:self.mpp3.first_last_frame[1]]
-        # self.first_last_frame       =  self.mpp3.first_last_frame
+        if self.frames_range is not None:
+            self.frames_range  =  [self.frames_range[0] + self.mpp3.first_last_frame[0], self.frames_range[0] + self.mpp3.first_last_frame[0] + self.raw_data.raw_data.shape[0]]     # analysed time window in the loaded stack (chops add up)
         self.mpp3.close()
         self.frame_raw_mip.setImage(self.raw_data.raw_data_mip)
 
@@ -423,7 +442,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.raw_data.raw_data_mip  =  self.raw_data.raw_data_mip[:, x0:x1, y0:y1]
         self.frame_raw_mip.setImage(self.raw_data.raw_data_mip, autoRange=False)
         self.mpp4.close()
-        self.crop_roi_raw  =  np.array([x0, y0, x1, y1])
+        self.crop_roi_raw  =  np.array([self.crop_roi_raw[0] + x0, self.crop_roi_raw[1] + y0, self.crop_roi_raw[0] + x1, self.crop_roi_raw[1] + y1])     # crop corners in the full frame (crops add up)
 
     def load_raw_data(self):
         """Load and visualize raw_data."""
@@ -446,16 +465,31 @@ class MainWindow(QtWidgets.QMainWindow):
             msgBox.setText("You did not select any file.")
             if len(self.fnames) == 0:
                 msgBox.exec()
-            if self.fnames[0][-4:] == ".czi":
-                self.pre_nopre_flag  =  ServiceWidgets.PresmoothingFlag.getFlag()
-                if self.pre_nopre_flag:
-                    # self.raw_data  =  LoadRawData.LoadRawDataCziPresmooth(self.fnames[::-1])    # THIS COMES FOR A PARTICULAR ISSUE VIRGINIA HAD
-                    self.raw_data  =  LoadRawData.LoadRawDataCziPresmooth(self.fnames)
-                elif not self.pre_nopre_flag:
-                    # self.raw_data  =  LoadRawData.LoadRawDataCzi(self.fnames[::-1])
-                    self.raw_data  =  LoadRawData.LoadRawDataCzi(self.fnames)
-            elif self.fnames[0][-4:] == ".tif":
-                self.raw_data  =  LoadRawData.LoadRawDataTiff(self.fnames)
+            raw_data    =  None
+            stack_path  =  LoadRawData.temp_stack_path()                                         # temporary file of the stack, mapped by the detection workers
+            try:
+                if self.fnames[0][-4:] == ".czi":
+                    self.pre_nopre_flag  =  ServiceWidgets.PresmoothingFlag.getFlag()
+                    if LazyStack.lazy_cache_mb() > 0:
+                        raw_data  =  LoadRawData.LoadRawDataCziLazy(self.fnames, presmooth_flag=self.pre_nopre_flag)     # frames are decoded only when they are used
+                    elif self.pre_nopre_flag:
+                        # self.raw_data  =  LoadRawData.LoadRawDataCziPresmooth(self.fnames[::-1])    # THIS COMES FOR A PARTICULAR ISSUE VIRGINIA HAD
+                        raw_data  =  LoadRawData.LoadRawDataCziPresmooth(self.fnames, mmap_path=stack_path)
+                    elif not self.pre_nopre_flag:
+                        # self.raw_data  =  LoadRawData.LoadRawDataCzi(self.fnames[::-1])
+                        raw_data  =  LoadRawData.LoadRawDataCzi(self.fnames, mmap_path=stack_path)
+                elif self.fnames[0][-4:] == ".tif":
+                    if LazyStack.lazy_cache_mb() > 0:
+                        raw_data  =  LoadRawData.LoadRawDataTiffLazy(self.fnames)
+                    else:
+                        raw_data  =  LoadRawData.LoadRawDataTiff(self.fnames, mmap_path=stack_path)
+            finally:
+                if getattr(raw_data, "mmap_path", None) != stack_path:
+                    LoadRawData.remove_stack_file(stack_path)                                   # not used (lazy loading) or loading failed
+
+            if raw_data is not None:
+                self.close_raw_data()                                                               # the old data are released only when the new ones are loaded
+                self.raw_data  =  raw_data
 
             self.frame_raw_mip.setImage(self.raw_data.raw_data_mip)
             self.pixsize_x_lbl.setText("pix size XY = " + str(np.round(self.raw_data.pix_size_xy, decimals=4)) + "µm;")
@@ -464,6 +498,7 @@ class MainWindow(QtWidgets.QMainWindow):
             # self.pixsize_z_lbl.setText("Z step = " + str(np.round(self.raw_data.pix_size_z * 1000000, decimals=4)) + "µm;")
             self.time_step_lbl.setText("Time Step = " + str(np.round(self.raw_data.time_step_value, decimals=4)) + "s")
             self.crop_roi_raw  =  [0, 0, self.raw_data.raw_data_mip.shape[1], self.raw_data.raw_data_mip.shape[2]]
+            self.frames_range  =  [0, self.raw_data.raw_data_mip.shape[0]]
 
         except Exception:
             traceback.print_exc()
@@ -476,14 +511,20 @@ class MainWindow(QtWidgets.QMainWindow):
         QtWidgets.QApplication.processEvents()
         QtWidgets.QApplication.processEvents()
 
+        pbar  =  ServiceWidgets.ProgressBar()
+        pbar.show()
         try:
-            self.spots_3d_det  =  SpotsDetectionChopper.SpotsDetectionChopper(self.raw_data.raw_data, self.spts_thr_value, self.min_volthr_value, self.merge_radius_value)
+            self.spots_3d_det  =  SpotsDetectionChopper.SpotsDetectionChopper(self.raw_data.raw_data, self.spts_thr_value, self.min_volthr_value, self.merge_radius_value,
+                                                                              np.load('gauss_kern_size.npy'), WorkersPool.workers_numb(),
+                                                                              filter_backend=SpotsDetection3D.read_filter_backend(), pix_sizes=(self.raw_data.pix_size_z, self.raw_data.pix_size_xy),
+                                                                              progress_callback=pbar.progress)
             self.frame_segm_mip.setImage(self.spots_3d_det.spots_2d_lbls, autoRange=False)
             self.rnd_cmap      =  pg.ColorMap(np.linspace(0, 1, self.spots_3d_det.spots_2d_lbls.max()), color=self.colors4map)
             self.frame_segm_mip.setColorMap(self.rnd_cmap)
             self.tabs_mip.setTabText(1, "Segmented")
         except Exception:
             traceback.print_exc()
+        pbar.close()
         self.ready_indicator()
 
     def track_spts(self):
@@ -493,8 +534,10 @@ class MainWindow(QtWidgets.QMainWindow):
         QtWidgets.QApplication.processEvents()
         QtWidgets.QApplication.processEvents()
 
+        pbar  =  ServiceWidgets.ProgressBar()
+        pbar.show()
         try:
-            self.spots_trckd  =  SpotsTracker.SpotsTracker(self.spots_3d_det.spots_2d_lbls, self.dist_thr_value)
+            self.spots_trckd  =  SpotsTracker.SpotsTracker(self.spots_3d_det.spots_2d_lbls, self.dist_thr_value, link_mode=SpotsTracker.read_link_mode(), progress_callback=pbar.progress)
             self.frame_segm_mip.setImage(self.spots_trckd.spts_trck_fin, autoRange=False)
             self.frame_segm_mip.setCurrentIndex(self.frame_raw_mip.currentIndex)
             self.rnd_cmap     =  pg.ColorMap(np.linspace(0, 1, self.spots_trckd.spts_trck_fin.max()), color=self.colors4map)
@@ -503,6 +546,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         except Exception:
             traceback.print_exc()
+        pbar.close()
         self.ready_indicator()
 
     def save_analysis(self):
@@ -516,11 +560,19 @@ class MainWindow(QtWidgets.QMainWindow):
 
         try:
             analysis_folder  =  str(QtWidgets.QFileDialog.getExistingDirectory(None, "Select the Directory to save the Analysis"))
-            spots_features   =  SpotsFeatureExtractor.SpotsFeatureExtractor(self.spots_trckd.spts_trck_fin, self.spots_3d_det.spots_coords, self.raw_data.raw_data)
+            min_act_frames   =  ServiceWidgets.InputScalar.getFlag(["Act frames thr:", " ", "Enter", "Minimum number of non-zeros frames to keep the nuclear time trace", "Enter the value", "Active Frames"])
+            pbar             =  ServiceWidgets.ProgressBar()
+            pbar.show()
+            spots_features   =  SpotsFeatureExtractor.SpotsFeatureExtractor(self.spots_trckd.spts_trck_fin, self.spots_3d_det.spots_coords, self.raw_data.raw_data, min_act_frames, progress_callback=pbar.progress)
+            pbar.close()
             AnalysisSaver.AnalysisSaver(analysis_folder, self.fnames, self.raw_data, self.soft_version, self.spots_3d_det, self.spots_trckd, self.merge_radius_value, self.spts_thr_value,
-                                        self.min_volthr_value, self.dist_thr_value, spots_features, self.crop_roi_raw, self.raw_data.ch_numb, self.pre_nopre_flag)
+                                        self.min_volthr_value, self.dist_thr_value, spots_features, self.crop_roi_raw, self.raw_data.ch_numb, self.pre_nopre_flag, np.load('gauss_kern_size.npy'), self.frames_range)
             # shutil.copyfile('gauss_kern_size.npy', '/home/atrullo/Dropbox/JamesData/NC_13th_2023_03_11_e01/gauss_kern_size.npy')
             shutil.copyfile('gauss_kern_size.npy', analysis_folder + '/gauss_kern_size.npy')
+            if os.path.isfile('filter_backend.npy'):
+                shutil.copyfile('filter_backend.npy', analysis_folder + '/filter_backend.npy')
+            if os.path.isfile('link_mode.npy'):
+                shutil.copyfile('link_mode.npy', analysis_folder + '/link_mode.npy')
             # GalleryDividedByBckg.GalleryDividedByBckg(analysis_folder + '/SpotsAnalysis.xlsx')
         except Exception:
             traceback.print_exc()
@@ -528,7 +580,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def test_spots_detection(self):
         """Launch test spots detection tool."""
-        self.mpp1  =  TestSpotsDetectionSetting(self.raw_data.raw_data_mip, self.raw_data.raw_data, self.raw_data.time_step_value)
+        self.mpp1  =  TestSpotsDetectionSetting(self.raw_data.raw_data_mip, self.raw_data.raw_data, self.raw_data.time_step_value, (self.raw_data.pix_size_z, self.raw_data.pix_size_xy))
         self.mpp1.show()
         self.mpp1.procStart.connect(self.insert_close_spots_test)
 
@@ -558,6 +610,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.frame_raw_mip.clear()
             self.frame_segm_mip.clear()
 
+            self.close_raw_data()
             self.raw_data            =  AnalysisLoader.RawData(analysis_folder, self.fnames)
             params                   =  AnalysisLoader.AnalysisParameters(analysis_folder)
             self.merge_radius_value  =  params.merge_radius_value
@@ -574,6 +627,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.time_step_lbl.setText("Time Step = " + str(np.round(self.raw_data.time_step_value, decimals=4)) + "s")
             self.crop_roi_raw    =  np.load(analysis_folder + '/crop_roi.npy')
             self.pre_nopre_flag  =  np.load(analysis_folder + '/pre_nopre_flag.npy')
+            self.frames_range    =  self.raw_data.frames_range
 
             self.spots_3d_det  =  AnalysisLoader.SpotsDetected(analysis_folder)
             self.spots_trckd   =  AnalysisLoader.SpotsTracked(analysis_folder)
@@ -630,7 +684,7 @@ class MainWindow(QtWidgets.QMainWindow):
         analysis_folder  =  str(QtWidgets.QFileDialog.getExistingDirectory(None, "Select the analysis folder"))
         fnames           =  natsorted(QtWidgets.QFileDialog.getOpenFileNames(None, "Select czi (or lsm) data files to concatenate...", filter="*.lsm *.czi *.tif *.lif")[0])
         raw_data         =  AnalysisLoader.RawData(analysis_folder, fnames)
-        phtblc           =  PhotoBleachingEstimate.PhotoBleachingEstimate(analysis_folder, raw_data)
+        phtblc           =  PhotoBleachingEstimate.PhotoBleachingEstimate(analysis_folder, raw_data, WorkersPool.workers_numb())
         self.mpp6        =  PhotobleachingTool(phtblc, fnames, analysis_folder, self.soft_version)
         self.mpp6.show()
 
@@ -669,6 +723,12 @@ class SettingsChanges(QtWidgets.QWidget):
         self.ksf_h   =  np.load('keys_size_factor.npy')[0]
         self.ksf_w   =  np.load('keys_size_factor.npy')[1]
         self.g_kern  =  np.load('gauss_kern_size.npy').astype(np.float64)
+        self.w_numb  =  WorkersPool.workers_numb()
+        self.f_bknd  =  SpotsDetection3D.read_filter_backend()
+        self.c_gb    =  RawDataCache.cache_max_bytes() / 1e9
+        self.l_mb    =  LazyStack.lazy_cache_mb()
+        self.p_gb    =  RawDataCache.prefetch_max_bytes() / 1e9
+        self.l_mode  =  SpotsTracker.read_link_mode()
 
         ksf_h_lbl  =  QtWidgets.QLabel("Keys Scale Factor W")
 
@@ -694,6 +754,58 @@ class SettingsChanges(QtWidgets.QWidget):
         gaus_kern_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
         gaus_kern_edt.setText(str(self.g_kern))
 
+        workers_numb_lbl  =  QtWidgets.QLabel("Workers Number")
+
+        workers_numb_edt  =  QtWidgets.QLineEdit(self)
+        workers_numb_edt.textChanged[str].connect(self.w_numb_var)
+        workers_numb_edt.setToolTip("Sets the number of parallel workers (0 means one per cpu)")
+        workers_numb_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        workers_numb_edt.setText(str(self.w_numb))
+
+        cache_gb_lbl  =  QtWidgets.QLabel("Raw Data Cache (GB)")
+
+        cache_gb_edt  =  QtWidgets.QLineEdit(self)
+        cache_gb_edt.textChanged[str].connect(self.c_gb_var)
+        cache_gb_edt.setToolTip("Sets the maximum disk space of the cache of decoded raw data, stored in ~/.OptoTrack (0, the default, switches the cache off)")
+        cache_gb_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        cache_gb_edt.setText(str(self.c_gb))
+
+        prefetch_gb_lbl  =  QtWidgets.QLabel("Decode Ahead Memory (GB)")
+
+        prefetch_gb_edt  =  QtWidgets.QLineEdit(self)
+        prefetch_gb_edt.textChanged[str].connect(self.p_gb_var)
+        prefetch_gb_edt.setToolTip("Sets the memory for the files decoded in background while loading several files")
+        prefetch_gb_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        prefetch_gb_edt.setText(str(self.p_gb))
+
+        lazy_mb_lbl  =  QtWidgets.QLabel("Lazy Loading Cache (MB)")
+
+        lazy_mb_edt  =  QtWidgets.QLineEdit(self)
+        lazy_mb_edt.textChanged[str].connect(self.l_mb_var)
+        lazy_mb_edt.setToolTip("Sets the memory of the decoded frames cache when raw data are opened lazily (0 loads the whole raw data)")
+        lazy_mb_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        lazy_mb_edt.setText(str(self.l_mb))
+
+        filter_bknd_lbl  =  QtWidgets.QLabel("Filter Backend")
+
+        filter_bknd_combo  =  QtWidgets.QComboBox(self)
+        for k in SpotsDetection3D.FILTER_BACKENDS:
+            filter_bknd_combo.addItem(k)
+        filter_bknd_combo.setCurrentText(self.f_bknd)
+        filter_bknd_combo.currentTextChanged[str].connect(self.f_bknd_var)
+        filter_bknd_combo.setToolTip("Sets the spots detection filter: gaussian + laplacian (original), Laplacian of Gaussian or FFT (these two are anisotropic, following the pixel sizes; Laplacian of Gaussian raises sigmas below half a pixel, use FFT for thinner kernels)")
+        filter_bknd_combo.setFixedSize(int(self.ksf_h * 100), int(self.ksf_w * 25))
+
+        link_mode_lbl  =  QtWidgets.QLabel("Linking Mode")
+
+        link_mode_combo  =  QtWidgets.QComboBox(self)
+        for k in SpotsTracker.LINK_MODES:
+            link_mode_combo.addItem(k)
+        link_mode_combo.setCurrentText(self.l_mode)
+        link_mode_combo.currentTextChanged[str].connect(self.l_mode_var)
+        link_mode_combo.setToolTip("Sets the tracking: greedy (original, one track at the time) or global (all the tracks linked together frame by frame)")
+        link_mode_combo.setFixedSize(int(self.ksf_h * 100), int(self.ksf_w * 25))
+
         save_btn  =  QtWidgets.QPushButton("Save", self)
         save_btn.clicked.connect(self.save_vars)
         save_btn.setToolTip('Make default the choseen parameters')
@@ -721,6 +833,18 @@ class SettingsChanges(QtWidgets.QWidget):
         layout_grid.addWidget(ksf_w_edt, 1, 1)
         layout_grid.addWidget(gaus_kern_lbl, 2, 0)
         layout_grid.addWidget(gaus_kern_edt, 2, 1)
+        layout_grid.addWidget(workers_numb_lbl, 3, 0)
+        layout_grid.addWidget(workers_numb_edt, 3, 1)
+        layout_grid.addWidget(filter_bknd_lbl, 4, 0)
+        layout_grid.addWidget(filter_bknd_combo, 4, 1)
+        layout_grid.addWidget(cache_gb_lbl, 5, 0)
+        layout_grid.addWidget(cache_gb_edt, 5, 1)
+        layout_grid.addWidget(lazy_mb_lbl, 6, 0)
+        layout_grid.addWidget(lazy_mb_edt, 6, 1)
+        layout_grid.addWidget(prefetch_gb_lbl, 7, 0)
+        layout_grid.addWidget(prefetch_gb_edt, 7, 1)
+        layout_grid.addWidget(link_mode_lbl, 8, 0)
+        layout_grid.addWidget(link_mode_combo, 8, 1)
 
         layout  =  QtWidgets.QVBoxLayout()
         layout.addLayout(layout_grid)
@@ -743,10 +867,40 @@ class SettingsChanges(QtWidgets.QWidget):
         """Set the kernel size of gaussian filter."""
         self.g_kern  =  np.float64(text)
 
+    def w_numb_var(self, text):
+        """Set the number of parallel workers."""
+        self.w_numb  =  int(text)
+
+    def c_gb_var(self, text):
+        """Set the maximum size of the raw data cache."""
+        self.c_gb  =  np.float64(text)
+
+    def p_gb_var(self, text):
+        """Set the memory for the files decoded ahead."""
+        self.p_gb  =  np.float64(text)
+
+    def l_mb_var(self, text):
+        """Set the memory of the lazy loading frames cache."""
+        self.l_mb  =  np.float64(text)
+
+    def f_bknd_var(self, text):
+        """Set the filter backend of spots detection."""
+        self.f_bknd  =  text
+
+    def l_mode_var(self, text):
+        """Set the linking mode of spots tracking."""
+        self.l_mode  =  text
+
     def save_vars(self):
         """Save new settings."""
         np.save('keys_size_factor.npy', [self.ksf_h, self.ksf_w])
         np.save('gauss_kern_size.npy', self.g_kern)
+        np.save('workers_numb.npy', self.w_numb)
+        np.save('filter_backend.npy', self.f_bknd)
+        np.save('raw_cache_gb.npy', self.c_gb)
+        np.save('lazy_cache_mb.npy', self.l_mb)
+        np.save('prefetch_gb.npy', self.p_gb)
+        np.save('link_mode.npy', self.l_mode)
 
     def close_(self):
         """Close the widget."""
@@ -762,13 +916,13 @@ class TestSpotsDetectionSetting(QtWidgets.QWidget):
     """Popup tool to study spots detection."""
     procStart  =  QtCore.pyqtSignal()
 
-    def __init__(self, spts_mip, spts_4d, time_step_value):
+    def __init__(self, spts_mip, spts_4d, time_step_value, pix_sizes=None):
         QtWidgets.QWidget.__init__(self)
 
         ksf_h  =  np.load('keys_size_factor.npy')[0]
         ksf_w  =  np.load('keys_size_factor.npy')[1]
 
-        frame1  =  pg.ImageView(self, name='Frame1')
+        frame1  =  LazyImageView(self, name='Frame1')
         # frame1.setImage(raw_mip_data)
         frame1.setImage(spts_mip)
         frame1.ui.roiBtn.hide()
@@ -928,6 +1082,7 @@ class TestSpotsDetectionSetting(QtWidgets.QWidget):
         self.time_step_value  =  time_step_value
         self.spts_4d          =  spts_4d
         self.spts_mip         =  spts_mip
+        self.pix_sizes        =  pix_sizes
         self.ready_busy_lbl   =  ready_busy_lbl
 
         self.setLayout(layout)
@@ -978,7 +1133,8 @@ class TestSpotsDetectionSetting(QtWidgets.QWidget):
         QtWidgets.QApplication.processEvents()
 
         try:
-            spots  =  SpotsDetection3D.SpotsDetection3D_Single4Test([self.spts_4d[self.cif, :, :, :], self.spots_thr_value, self.volume_thr_value, self.merge_radius_value])
+            spots  =  SpotsDetection3D.SpotsDetection3D_Single4Test([self.spts_4d[self.cif, :, :, :], self.spots_thr_value, self.volume_thr_value, self.merge_radius_value, "vect", 0,
+                                                                    np.load('gauss_kern_size.npy'), SpotsDetection3D.read_filter_backend(), self.pix_sizes])
             # self.frame2.setImage(np.sign(spots.spots_ints))
             self.frame2.setImage(spots.spots_clean)
             self.clean_cmap  =  pg.ColorMap(np.linspace(0, 1, spots.spots_clean.max()), color=self.colors4map)
@@ -1009,7 +1165,7 @@ class ChopStack(QtWidgets.QWidget):
         ksf_h  =  np.load('keys_size_factor.npy')[0]
         ksf_w  =  np.load('keys_size_factor.npy')[1]
 
-        frame_raw  =  pg.ImageView(self, name='FrameSpts1')
+        frame_raw  =  LazyImageView(self, name='FrameSpts1')
         frame_raw.ui.roiBtn.hide()
         frame_raw.ui.menuBtn.hide()
         frame_raw.setImage(raw_data)
@@ -1093,7 +1249,7 @@ class CropStack(QtWidgets.QWidget):
 
         crop_roi_raw  =  pg.RectROI([80, 80], [80, 80], pen='r')
 
-        frame_raw  =  pg.ImageView(self)
+        frame_raw  =  LazyImageView(self)
         frame_raw.ui.roiBtn.hide()
         frame_raw.ui.menuBtn.hide()
         frame_raw.setImage(raw_data)
@@ -1367,7 +1523,8 @@ class GenerateImage(QtWidgets.QWidget):
         colors4map     =  colors4map + colors4map + colors4map + colors4map + colors4map + colors4map
         colors4map[0]  =  np.array([0, 0, 0])
 
-        spots_tr  =  SaveReadMatrix.SpotsMatrixReader(analysis_folder, '/spots_trck.npy').spts_lbls
+        spots_frs  =  SaveReadMatrix.SpotsMatrixFrames(analysis_folder, '/spots_trck.npy')
+        spots_tr   =  spots_frs.lazy_stack()                                                 # frames are rebuilt when they are shown
 
         ksf_h  =  np.load('keys_size_factor.npy')[0]
         ksf_w  =  np.load('keys_size_factor.npy')[1]
@@ -1385,7 +1542,7 @@ class GenerateImage(QtWidgets.QWidget):
         frame_segmspots.view.setXLink("FrameRaw")
         frame_segmspots.view.setYLink("FrameRaw")
         frame_segmspots.timeLine.sigPositionChanged.connect(self.update_from_segmspots)
-        rnd_cmap       =  pg.ColorMap(np.linspace(0, 1, spots_tr.max()), color=colors4map)
+        rnd_cmap       =  pg.ColorMap(np.linspace(0, 1, spots_frs.max()), color=colors4map)
         frame_segmspots.setColorMap(rnd_cmap)
 
         tabs_tot  =  QtWidgets.QTabWidget()
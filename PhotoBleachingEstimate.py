@@ -11,6 +11,8 @@ import datetime
 
 import AnalysisLoader
 import ServiceWidgets
+import SharedArrays
+import WorkersPool
 
 
 def exp_func(x, a, c, d):
@@ -18,12 +20,35 @@ def exp_func(x, a, c, d):
     return a * np.exp(-c * x) + d
 
 
+class PhotoBleachingFrame:
+    """Average intensity of spots and background in a single time frame: works in the pool on the frame itself, or on raw data memory mapped on a file."""
+    def __init__(self, in_args):
+
+        sub_coords  =  in_args[1]                                                                                       # coordinates of the spots in the time frame
+        tt          =  in_args[2]                                                                                       # time frame
+        raw_data    =  None
+        if isinstance(in_args[0], list):
+            raw_data   =  SharedArrays.MmapArrayAttach(in_args[0])                                                     # map the raw data from their file
+            raw_frame  =  raw_data.arr[tt]
+        else:
+            raw_frame  =  in_args[0]                                                                                    # the frame was sent to the worker
+
+        sing_fr3d                                                        =  np.zeros(raw_frame.shape, dtype=np.uint16)  # initialize the 3D single time frame matrix
+        sing_fr3d[sub_coords[:, 1], sub_coords[:, 2], sub_coords[:, 3]]  =  1                                           # build the 3D single frame
+        sing_fr3d_exp                                                    =  expand_labels(sing_fr3d, distance=3)        # expand the spots to avoid to include diffraction patterns in the background estimation
+        self.spts_ints                                                   =  np.sum(raw_frame * sing_fr3d) / sing_fr3d.sum()     # mask 3D single frame raw data with spots mask and divide by the total volume of the detected spots
+        self.bckg_ints                                                   =  np.sum(raw_frame * (1 - sing_fr3d_exp)) / (1 - sing_fr3d_exp).sum()     # mask raw data with the 'negative' of the expanded spots and divided by the total volume of the 'negative'
+
+        if raw_data is not None:
+            raw_data.close()
+
+
 class PhotoBleachingEstimate:
     """Only class, does all the job."""
-    def __init__(self, analysis_folder, raw_data):
+    def __init__(self, analysis_folder, raw_data, workers):
 
         spts_det  =  AnalysisLoader.SpotsDetected(analysis_folder)                                                      # load detected spots
-        tlen      =  spts_det.spots_2d_lbls.shape[0]                                                                    # number of time steps
+        tlen      =  spts_det.tlen                                                                                      # number of time steps
 
         spts_ints_prof  =  np.zeros(tlen)                                                                               # initialize the vector with the average signal intensity
         bckg_ints_prof  =  np.zeros(tlen)                                                                               # initialize the vector with the average background intensity
@@ -32,14 +57,13 @@ class PhotoBleachingEstimate:
         pbar.show()
         pbar.update_progressbar1(0)
 
-        for tt in range(tlen):                                                                                          # for each time frame
+        raw_desc  =  SharedArrays.mmap_desc(raw_data.raw_data)                                                         # raw data on a file are mapped by the workers, otherwise each worker receives its frame: raw data are never copied as a whole
+        job_args  =  ([raw_desc if raw_desc is not None else raw_data.raw_data[tt], spts_det.coords_frame(tt), tt] for tt in range(tlen))     # frames are taken one by one, as the pool sends them
+
+        for tt, res in enumerate(WorkersPool.get_pool(workers).imap(PhotoBleachingFrame, job_args)):                        # results arrive in the frames order
             pbar.update_progressbar1(tt)
-            sub_coords                                                       =  spts_det.spots_coords[spts_det.spots_coords[:, 0] == tt]     # extract the coordinate of the current time frame
-            sing_fr3d                                                        =  np.zeros((spts_det.spots_coords[-1, 1], spts_det.spots_coords[-1, 2], spts_det.spots_coords[-1, 3]), dtype=np.uint16)   # initialize the 3D single time frame matrix
-            sing_fr3d[sub_coords[:, 1], sub_coords[:, 2], sub_coords[:, 3]]  =  1                                       # build the 3D single frame
-            sing_fr3d_exp                                                    =  expand_labels(sing_fr3d, distance=3)    # expand the spots to avoid to include diffraction patterns in the background estimation
-            spts_ints_prof[tt]                                               =  np.sum(raw_data.raw_data[tt] * sing_fr3d) / sing_fr3d.sum()     # mask 3D single frame raw data with spots mask and divide by the total volume of the detected spots
-            bckg_ints_prof[tt]                                               =  np.sum(raw_data.raw_data[tt] * (1 - sing_fr3d_exp)) / (1 - sing_fr3d_exp).sum()     # mask raw data with the 'negative' of the expanded spots and divided by the total volume of the 'negative'
+            spts_ints_prof[tt]  =  res.spts_ints
+            bckg_ints_prof[tt]  =  res.bckg_ints
 
         pbar.close()
 
@@ -0,0 +1,58 @@
+"""This function presmooths raw data with a fixed gaussian kernel.
+
+Input is a TxZxXxY matrix, smoothed in place; output is its MIP. Each frame is
+filtered in float32 by scipy (which releases the GIL), so frames are smoothed in
+parallel by a pool of threads, and the MIP of a frame is taken while the frame is
+still in cache. The float64 skimage filter of the first versions is kept for the
+analyses done with it: its output is not exactly the same.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+from skimage.filters import gaussian
+
+import WorkersPool
+
+
+PRESMOOTH_SIGMA  =  1.5                                     # fixed kernel of the gaussian filter
+PRESMOOTH_SCALE  =  1000                                    # smoothed values are in [0, 1] (as skimage gives them), they are scaled to integers
+THREAD_BUFFS     =  threading.local()                       # float32 buffer of each thread, reused frame after frame
+
+
+def presmooth_frame(frame, out=None, mip_out=None, smooth_dtype=np.float32):
+    """Presmooth a z-x-y frame: the result goes in out (it can be frame itself) and its MIP in mip_out."""
+    out  =  np.empty(frame.shape, dtype=np.uint16) if out is None else out
+
+    if np.dtype(smooth_dtype) == np.float64:
+        out[:]  =  (gaussian(frame, PRESMOOTH_SIGMA) * PRESMOOTH_SCALE).astype(np.uint16)             # original implementation
+
+    else:
+        buff  =  getattr(THREAD_BUFFS, "buff", None)
+        if buff is None or buff.shape != frame.shape:
+            buff               =  np.empty(frame.shape, dtype=np.float32)
+            THREAD_BUFFS.buff  =  buff
+        buff[:]  =  frame
+        ndimage.gaussian_filter(buff, PRESMOOTH_SIGMA, output=buff, mode='nearest', truncate=4.0)    # same filter of skimage, in place
+        scale    =  PRESMOOTH_SCALE / np.iinfo(frame.dtype).max if np.issubdtype(frame.dtype, np.integer) else PRESMOOTH_SCALE     # skimage rescales integer images in [0, 1]
+        buff    *=  np.float32(scale)
+        np.copyto(out, buff, casting='unsafe')                                                          # truncation, as astype(np.uint16) does
+
+    if mip_out is not None:
+        np.max(out, axis=0, out=mip_out)
+    return out
+
+
+def presmooth_stack(raw_data, smooth_dtype=np.float32, threads=None):
+    """Presmooth in place all the frames of raw_data, in parallel: output is the MIP of the smoothed stack."""
+    threads       =  WorkersPool.workers_numb() if threads is None else threads
+    raw_data_mip  =  np.empty((raw_data.shape[0],) + raw_data.shape[2:], dtype=raw_data.dtype)
+
+    def smooth_tt(tt):
+        presmooth_frame(raw_data[tt], raw_data[tt], raw_data_mip[tt], smooth_dtype)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(smooth_tt, range(raw_data.shape[0])))
+
+    return raw_data_mip
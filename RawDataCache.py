@@ -0,0 +1,151 @@
+"""This function keeps an on-disk cache of the decoded raw data files.
+
+Decoding (and presmoothing) a .czi file is the slowest part of every loading. The
+first time a file is read, its TZXY matrix and its MIP are stored as .npy files in
+a cache folder; the following times they are opened as memory mapped matrices, so
+only the frames actually used are read from the disk. Entries are identified by
+file path, size and modification time, channel and presmoothing flag: a modified
+file gets a new entry; an entry that cannot be read is removed and the file decoded
+again. The maximum size of the cache (in GB) is a setting stored in 'raw_cache_gb.npy'
+(0, the default, switches the cache off); the least recently used entries are removed
+first.
+Files of a split acquisition are decoded ahead in background threads while the
+previous ones are copied in the stack, within a memory budget (in GB) stored in
+'prefetch_gb.npy'.
+"""
+
+import os
+import os.path
+import shutil
+import hashlib
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from aicsimageio import AICSImage
+
+import RawDataProjections
+import Presmoothing
+import WorkersPool
+
+
+CACHE_DIR     =  os.path.join(os.path.expanduser("~"), ".OptoTrack", "raw_data_cache")
+CACHE_MAX_GB  =  0                                                                          # default maximum size of the cache: off until the user sets it
+PREFETCH_GB   =  4                                                                          # default memory for files decoded ahead
+
+
+def cache_max_bytes():
+    """Read the maximum size of the cache."""
+    max_gb  =  CACHE_MAX_GB
+    if os.path.isfile('raw_cache_gb.npy'):
+        max_gb  =  float(np.load('raw_cache_gb.npy'))
+    return int(max_gb * 1e9)
+
+
+def prefetch_max_bytes():
+    """Read the memory budget of the files decoded ahead."""
+    max_gb  =  PREFETCH_GB
+    if os.path.isfile('prefetch_gb.npy'):
+        max_gb  =  float(np.load('prefetch_gb.npy'))
+    return int(max_gb * 1e9)
+
+
+def cache_key(fname, ch_numb, presmooth_flag, smooth_dtype=np.float64):
+    """Name of the cache entry of a file."""
+    fstat  =  os.stat(fname)
+    key    =  "%s|%d|%d|%d|%d" % (os.path.abspath(fname), fstat.st_size, fstat.st_mtime_ns, int(ch_numb), int(bool(presmooth_flag)))
+    if presmooth_flag and np.dtype(smooth_dtype) != np.float64:
+        key  +=  "|" + np.dtype(smooth_dtype).name                                          # float32 and float64 presmoothing give slightly different values
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def decode_czi(fname, ch_numb, presmooth_flag, t_slice=None, smooth_dtype=np.float32):
+    """Decode a .czi file (and presmooth it if required): output are the TZXY matrix and its MIP. With t_slice only those time frames are decoded."""
+    if t_slice is None:
+        raw_data  =  AICSImage(fname).get_image_data("TZXY", C=ch_numb)
+    else:
+        raw_data  =  AICSImage(fname).get_image_dask_data("TZXY", C=ch_numb)[t_slice].compute()
+    if presmooth_flag:
+        return raw_data, Presmoothing.presmooth_stack(raw_data, smooth_dtype)              # frames smoothed in parallel, MIP taken on the fly
+    return raw_data, RawDataProjections.mip(raw_data)
+
+
+def entries_size(cache_dir):
+    """Size on the disk of each entry of the cache, with its last use time."""
+    entries  =  []
+    for entry in os.listdir(cache_dir):
+        entry_dir  =  os.path.join(cache_dir, entry)
+        if os.path.isdir(entry_dir) and not entry.endswith(".tmp"):
+            size  =  sum(os.path.getsize(os.path.join(entry_dir, ff)) for ff in os.listdir(entry_dir))
+            entries.append([os.path.getmtime(entry_dir), size, entry_dir])
+    return entries
+
+
+def evict(cache_dir, max_bytes):
+    """Remove the least recently used entries until the cache fits max_bytes."""
+    entries  =  sorted(entries_size(cache_dir))
+    tot      =  sum(entry[1] for entry in entries)
+    for entry in entries:
+        if tot <= max_bytes:
+            break
+        shutil.rmtree(entry[2], ignore_errors=True)
+        tot  -=  entry[1]
+
+
+def load_czi_file(fname, ch_numb, presmooth_flag=False, cache_dir=None, t_slice=None, smooth_dtype=np.float32):
+    """TZXY matrix and MIP of a .czi file: memory mapped from the cache if present, otherwise decoded and stored in the cache. t_slice restricts the output to some time frames."""
+    cache_dir  =  CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes  =  cache_max_bytes()
+    if max_bytes <= 0:
+        return decode_czi(fname, ch_numb, presmooth_flag, t_slice, smooth_dtype)        # no cache: decode only the needed frames
+
+    t_slice    =  slice(None) if t_slice is None else t_slice
+
+    entry_dir  =  os.path.join(cache_dir, cache_key(fname, ch_numb, presmooth_flag, smooth_dtype))
+    if os.path.isdir(entry_dir):
+        try:
+            raw_data      =  np.load(entry_dir + '/raw_data.npy', mmap_mode='r')         # read only: the cached files are never modified, and the detection workers map them too
+            raw_data_mip  =  np.load(entry_dir + '/raw_data_mip.npy', mmap_mode='r')
+            if raw_data.shape[0] != raw_data_mip.shape[0]:
+                raise ValueError("Inconsistent cache entry " + entry_dir)
+            os.utime(entry_dir)                                                             # mark the entry as recently used
+            return raw_data[t_slice], raw_data_mip[t_slice]
+        except (OSError, ValueError):
+            traceback.print_exc()                                                           # corrupt or truncated entry: remove it and decode the file again
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    raw_data, raw_data_mip  =  decode_czi(fname, ch_numb, presmooth_flag, smooth_dtype=smooth_dtype)
+    tmp_dir                 =  entry_dir + ".tmp"                                           # the entry appears only when it is complete
+    try:
+        if raw_data.nbytes + raw_data_mip.nbytes <= max_bytes:
+            os.makedirs(tmp_dir, exist_ok=True)
+            np.save(tmp_dir + '/raw_data.npy', raw_data)
+            np.save(tmp_dir + '/raw_data_mip.npy', raw_data_mip)
+            os.rename(tmp_dir, entry_dir)
+            evict(cache_dir, max_bytes)
+    except OSError:
+        traceback.print_exc()                                                               # no space or no permission: go on without cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)                                          # do not leave a partial entry behind
+
+    return raw_data[t_slice], raw_data_mip[t_slice]
+
+
+def iter_czi_files(fnames, ch_numb, presmooth_flag=False, files_nbytes=None, t_slices=None, max_bytes=None):
+    """Generator of (file index, TZXY matrix, MIP) of the files in order: the following files are decoded in background threads while the current one is used, as long as the decoded and not yet used files fit max_bytes."""
+    max_bytes     =  prefetch_max_bytes() if max_bytes is None else max_bytes
+    files_nbytes  =  [0] * len(fnames) if files_nbytes is None else files_nbytes
+    t_slices      =  [None] * len(fnames) if t_slices is None else t_slices
+    threads       =  max(1, WorkersPool.workers_numb())
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending   =  deque()                                                                # submitted files, in order
+        nxt       =  0                                                                      # next file to submit
+        inflight  =  0                                                                      # memory of the submitted files not used yet
+        for cn in range(len(fnames)):
+            while nxt < len(fnames) and len(pending) <= threads and (nxt == cn or inflight + files_nbytes[nxt] <= max_bytes):     # the current file is always submitted
+                pending.append(executor.submit(load_czi_file, fnames[nxt], ch_numb, presmooth_flag, None, t_slices[nxt]))
+                inflight  +=  files_nbytes[nxt]
+                nxt       +=  1
+            raw_data, raw_data_mip  =  pending.popleft().result()
+            yield cn, raw_data, raw_data_mip
+            inflight  -=  files_nbytes[cn]                                                  # the caller copied the file: its memory is free
@@ -0,0 +1,47 @@
+"""This function computes projections along z of 4D (time-z-x-y) raw data.
+
+Input is a TxZxXxY matrix, output is a TxXxY matrix. The reduction over z is done
+by numpy on a block of time frames at the time: blocks keep temporary matrices
+small (median) and read lazy or memory mapped stacks chunk by chunk.
+"""
+
+import numpy as np
+
+
+def projection_dtype(raw_dtype, mode):
+    """dtype of the projection: raw data dtype for max, float64 for mean and median, a wider type for sum."""
+    raw_dtype  =  np.dtype(raw_dtype)
+    if mode == "max":
+        return raw_dtype
+    if mode == "sum":
+        if np.issubdtype(raw_dtype, np.integer):
+            return np.dtype(np.int64)
+        return np.dtype(np.float64)
+    return np.dtype(np.float64)
+
+
+def projection(raw_data, mode="max", t_chunk=8):
+    """Projection along z: mode is 'max' (maximum intensity projection), 'mean', 'sum' or 'median'."""
+    if mode not in ["max", "mean", "sum", "median"]:
+        raise ValueError("Unknown projection mode: " + str(mode))
+
+    tlen, zlen, xlen, ylen  =  raw_data.shape
+    proj                    =  np.empty((tlen, xlen, ylen), dtype=projection_dtype(raw_data.dtype, mode))
+    for t_start in range(0, tlen, t_chunk):
+        bff      =  np.asarray(raw_data[t_start:t_start + t_chunk])                                # a block of time frames (read from the disk if raw_data is lazy or memory mapped)
+        out_bff  =  proj[t_start:t_start + t_chunk]
+        if mode == "max":
+            np.max(bff, axis=1, out=out_bff)
+        elif mode == "mean":
+            np.mean(bff, axis=1, dtype=np.float64, out=out_bff)
+        elif mode == "sum":
+            np.sum(bff, axis=1, dtype=proj.dtype, out=out_bff)
+        else:
+            out_bff[:]  =  np.median(bff, axis=1)
+
+    return proj
+
+
+def mip(raw_data):
+    """Maximum intensity projection."""
+    return projection(raw_data, "max")
@@ -1,40 +1,135 @@
-"""This function writes and reads a spots matrix as a 5xN array.
-
-For each row of the array, there is the value of the tag and the t, z, x, y coordinates
-of all the non-zero pixels. This is very useful in case of sparse matrix.
+"""This function writes and reads a spots matrix in a sparse format.
+
+A T-x-y spots matrix is stored as a compressed .npz file (the .npy of the given file
+name becomes .npz) with its shape, the linear x-y position and the value of all the
+labelled pixels sorted by time frame, and the position of the first pixel of each
+frame (as the row pointer of a CSR matrix). Pixels are compressed in blocks of
+frames, so a frame or a range of frames is rebuilt decompressing only its blocks.
+Old analyses have a 4xN .npy array with the value and the t, x,
+y coordinates of each non-zero pixel (last row is the matrix shape): they are still
+read.
 """
 
+import os.path
 import numpy as np
-from skimage.measure import regionprops_table
 
+import LazyStack
 
-class SpotsMatrixReader:
-    """Function to reconstruct a spots matrix starting from its list of coordinates and tags."""
+
+BLOCK_FRAMES  =  16                                                                                         # frames of each compressed block: reading a frame decompresses only its block
+
+
+def sparse_fname(folder, fname):
+    """Path of the sparse format file."""
+    return folder + fname[:fname.rfind('.')] + '.npz'
+
+
+def values_dtype(values):
+    """Smallest integer type holding all the values."""
+    if values.size == 0:
+        return np.dtype(np.uint8)
+    return np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+
+
+class SpotsMatrixFrames:
+    """Random access to the time frames of a saved spots matrix: only the blocks of the asked frames are decompressed."""
     def __init__(self, folder, fname):
 
-        mtx2build  =  np.load(folder + fname)                                                                           # load the matrix
-        spts_lbls  =  np.zeros((mtx2build[-1, 1], mtx2build[-1, 2], mtx2build[-1, 3]), dtype=np.uint32)                 # initialize the matrix image with the info in the matrix
-        for kk in range(mtx2build.shape[0] - 1):
-            spts_lbls[mtx2build[kk, 1], mtx2build[kk, 2], mtx2build[kk, 3]]  =  mtx2build[kk, 0]                        # fill the matrix with the info
+        self.fname  =  sparse_fname(folder, fname)
+        self.block  =  [None, None, None]                                                                       # last decompressed block: number, x-y positions and values
+
+        if os.path.isfile(self.fname):
+            with np.load(self.fname) as sprs:                                                                   # only the header is read here
+                self.shape         =  tuple(sprs['shape'].tolist())
+                self.frame_ptr     =  sprs['frame_ptr']
+                self.block_frames  =  int(sprs['block_frames'])
+
+        else:                                                                                                   # old format: all the pixels are converted at once
+            mtx2build          =  np.load(folder + fname)
+            self.shape         =  tuple(mtx2build[-1, 1:].tolist())
+            mtx2build          =  mtx2build[:-1]
+            lin_idx            =  np.ravel_multi_index((mtx2build[:, 1], mtx2build[:, 2], mtx2build[:, 3]), self.shape)
+            order              =  np.argsort(lin_idx, kind='stable')
+            lin_idx            =  lin_idx[order]
+            self.frame_ptr     =  np.searchsorted(lin_idx // (self.shape[1] * self.shape[2]), np.arange(self.shape[0] + 1))
+            self.block_frames  =  max(self.shape[0], 1)                                                         # a single block, already in memory
+            self.block         =  [0, lin_idx % (self.shape[1] * self.shape[2]), mtx2build[order, 0]]
+
+    def block_pixels(self, bb):
+        """x-y positions and values of the pixels of the block bb."""
+        if self.block[0] != bb:
+            with np.load(self.fname) as sprs:
+                self.block  =  [bb, sprs['pix_idx_%d' % bb], sprs['values_%d' % bb]]
+        return self.block[1], self.block[2]
+
+    def frames(self, t_start, t_end):
+        """Rebuild the time frames from t_start to t_end (excluded)."""
+        frms  =  np.zeros((t_end - t_start, self.shape[1] * self.shape[2]), dtype=np.uint32)
+        for bb in range(t_start // self.block_frames, (t_end - 1) // self.block_frames + 1):
+            pix_idx, values  =  self.block_pixels(bb)
+            t0               =  max(t_start, bb * self.block_frames)                                            # asked frames inside the block
+            t1               =  min(t_end, (bb + 1) * self.block_frames)
+            p0, p1           =  self.frame_ptr[t0] - self.frame_ptr[bb * self.block_frames], self.frame_ptr[t1] - self.frame_ptr[bb * self.block_frames]
+            t_idx            =  np.repeat(np.arange(t0 - t_start, t1 - t_start), np.diff(self.frame_ptr[t0:t1 + 1]))     # frame of each pixel
+            frms[t_idx, pix_idx[p0:p1]]  =  values[p0:p1]                                                      # fill all the pixels at once
+        return frms.reshape((t_end - t_start,) + self.shape[1:])
+
+    def frame(self, t_frame):
+        """Rebuild the time frame t_frame."""
+        return self.frames(t_frame, t_frame + 1)[0]
+
+    def max(self):
+        """Highest value of the matrix."""
+        max_val  =  0
+        for bb in range((self.shape[0] - 1) // self.block_frames + 1):
+            values   =  self.block_pixels(bb)[1]
+            max_val  =  max(max_val, int(values.max())) if values.size > 0 else max_val
+        return max_val
+
+    def lazy_stack(self, cache_mb=256):
+        """The matrix as a LazyStack: frames are rebuilt when they are used (for the viewers)."""
+        return LazyStack.LazyStack(self.frame, self.shape[0], self.shape[1:], np.uint32, cache_mb)
+
+
+def read_frame(folder, fname, t_frame):
+    """Rebuild only the time frame t_frame of a saved spots matrix."""
+    return SpotsMatrixFrames(folder, fname).frame(t_frame)
+
+
+def read_frames(folder, fname, t_start, t_end):
+    """Rebuild only the time frames from t_start to t_end (excluded) of a saved spots matrix."""
+    return SpotsMatrixFrames(folder, fname).frames(t_start, t_end)
+
+
+class SpotsMatrixReader:
+    """Function to reconstruct a spots matrix starting from its non-zero pixels."""
+    def __init__(self, folder, fname):
 
-        self.spts_lbls  =  spts_lbls
+        spts_frames     =  SpotsMatrixFrames(folder, fname)
+        self.spts_lbls  =  spts_frames.frames(0, spts_frames.shape[0])
 
 
 class SpotsMatrixSaver:
-    """Function to write a ints spots matrix as a list of coordinates and tags."""
+    """Function to write a ints spots matrix as a sparse matrix."""
     def __init__(self, spts_lbls, folder, fname):
 
-        rgp_spts  =  regionprops_table(np.sign(spts_lbls), properties=["coords"])                                       # regionprops to create a dictionary with al the info
+        frame_size  =  spts_lbls.shape[1] * spts_lbls.shape[2]
+        nz_idx      =  np.flatnonzero(spts_lbls > 0)                                                         # labelled pixels (as in the old format, negative values are not stored), sorted by time frame
+        values      =  spts_lbls.reshape(-1)[nz_idx]
+        frame_ptr   =  np.searchsorted(nz_idx // frame_size, np.arange(spts_lbls.shape[0] + 1))              # first pixel of each frame
+        pix_idx     =  (nz_idx % frame_size).astype(np.uint32 if frame_size <= 2 ** 32 else np.uint64)
 
-        mtx2write  =  []                                                                                                # initialize list
-        for oo in rgp_spts["coords"]:
-            for cc in oo:
-                mtx2write.append([spts_lbls[cc[0], cc[1], cc[2]], cc[0], cc[1], cc[2]])                                 # each element of the list is a list with label, z coord, x coord, y coord of each pixel
+        values      =  values.astype(values_dtype(values))
 
-        mtx2write.append([0, spts_lbls.shape[0], spts_lbls.shape[1], spts_lbls.shape[2]])                               # last element is the size of the starting matrix image
-        mtx2write  =  np.asarray(mtx2write)                                                                             # convert to array and write
-        np.save(folder + fname, mtx2write)
+        blocks  =  {}                                                                                        # pixels of each block of BLOCK_FRAMES frames, compressed separately
+        for bb in range((spts_lbls.shape[0] - 1) // BLOCK_FRAMES + 1):
+            p0, p1                     =  frame_ptr[bb * BLOCK_FRAMES], frame_ptr[min((bb + 1) * BLOCK_FRAMES, spts_lbls.shape[0])]
+            blocks['pix_idx_%d' % bb]  =  pix_idx[p0:p1]
+            blocks['values_%d' % bb]   =  values[p0:p1]
 
+        np.savez_compressed(sparse_fname(folder, fname), shape=np.asarray(spts_lbls.shape), frame_ptr=frame_ptr, block_frames=BLOCK_FRAMES, **blocks)
+        if os.path.isfile(folder + fname):
+            os.remove(folder + fname)                                                                        # a matrix in the old format would be read by old versions instead of the new one
 
 
 
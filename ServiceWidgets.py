@@ -29,6 +29,11 @@ class ProgressBar(QtWidgets.QWidget):
         self.progressbar1.setValue(val1)
         QtWidgets.qApp.processEvents()
 
+    def progress(self, done, total):
+        """Update progressbar from the progress_callback of the compute classes."""
+        self.progressbar1.setMaximum(max(total, 1))
+        self.update_progressbar1(done)
+
 
 class ProgressBarDouble(QtWidgets.QWidget):
     """Double Progressbar widget."""
@@ -0,0 +1,66 @@
+"""This function shares numpy matrices among processes through shared memory blocks.
+
+The main process creates the block and copies (or writes) the data in it; the workers
+of the multiprocessing pool receive only a small descriptor (name, shape, dtype) and
+attach to the same memory, so big matrices are never pickled. Matrices already memory
+mapped on a file (in a shared mode) need no block at all: the workers map the same file.
+"""
+
+import mmap
+from multiprocessing import shared_memory
+import numpy as np
+
+
+MMAP_SHARED_MODES  =  ["r", "r+", "w+"]                                                     # copy on write ('c') mappings can differ from their file
+
+
+class SharedArray:
+    """Numpy matrix stored in a shared memory block, owned by the process that creates it."""
+    def __init__(self, shape, dtype):
+
+        dtype      =  np.dtype(dtype)
+        self.shm   =  shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))     # a block can not have size 0
+        self.arr   =  np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.desc  =  [self.shm.name, tuple(shape), dtype.str]                                                       # all what a worker needs to attach
+
+    def release(self):
+        """Free the block: matrices built on it must not be used anymore (copy them before)."""
+        del self.arr
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedArrayAttach:
+    """Attach to an already existing SharedArray by means of its descriptor."""
+    def __init__(self, desc):
+
+        self.shm  =  shared_memory.SharedMemory(name=desc[0])
+        self.arr  =  np.ndarray(desc[1], dtype=desc[2], buffer=self.shm.buf)
+
+    def close(self):
+        """Detach from the block (the block is not freed)."""
+        del self.arr
+        self.shm.close()
+
+
+def mmap_desc(arr):
+    """Descriptor (file, offset, shape, dtype, strides) of a matrix, or a view of it, memory mapped on a file in a shared mode: None for any other matrix."""
+    mm  =  getattr(arr, "_mmap", None)
+    if not isinstance(arr, np.memmap) or mm is None or arr.mode not in MMAP_SHARED_MODES or min(arr.strides, default=0) < 0:
+        return None
+    mm_start  =  arr.offset - arr.offset % mmap.ALLOCATIONGRANULARITY                     # file position of the beginning of the mapping
+    mm_addr   =  np.frombuffer(mm, dtype=np.uint8).ctypes.data                            # memory address of the beginning of the mapping
+    return [arr.filename, mm_start + arr.ctypes.data - mm_addr, arr.shape, arr.dtype.str, arr.strides]
+
+
+class MmapArrayAttach:
+    """Map (read only) the matrix of a mmap_desc descriptor."""
+    def __init__(self, desc):
+
+        self.mm   =  np.memmap(desc[0], dtype=np.uint8, mode='r')
+        self.arr  =  np.ndarray(desc[2], dtype=desc[3], buffer=self.mm, offset=desc[1], strides=desc[4])
+
+    def close(self):
+        """Unmap the file."""
+        del self.arr
+        del self.mm
@@ -0,0 +1,38 @@
+"""This function builds the matrix of the spots coordinates piece by piece.
+
+Each row of the matrix is the t, z, x, y coordinate of a spot pixel. Pieces (a spot, a
+frame, a worker result...) are stored in a list and joined only once at the end, instead
+of concatenating the whole matrix at every new piece.
+"""
+
+import numpy as np
+
+
+class SpotsCoordsBuilder:
+    """Growable t-z-x-y coordinates matrix."""
+    def __init__(self, dtype=np.int16):
+
+        self.pieces  =  []
+        self.n_rows  =  0
+        self.dtype   =  dtype
+
+    def append(self, coords):
+        """Add a piece of t-z-x-y coordinates (n x 4 matrix)."""
+        coords  =  np.asarray(coords, dtype=self.dtype)
+        if coords.shape[0] > 0:
+            self.pieces.append(coords)
+            self.n_rows  +=  coords.shape[0]
+
+    def append_frame(self, t, zxy):
+        """Add the z-x-y coordinates of some pixels of the time frame t."""
+        piece         =  np.empty((zxy.shape[0], 4), dtype=self.dtype)
+        piece[:, 0]   =  t
+        piece[:, 1:]  =  zxy
+        self.append(piece)
+
+    def array(self):
+        """Join all the pieces in a single matrix."""
+        coords  =  np.empty((self.n_rows, 4), dtype=self.dtype)
+        if self.n_rows > 0:
+            np.concatenate(self.pieces, axis=0, out=coords)
+        return coords
@@ -5,14 +5,163 @@ raw data (4D matrix) plus a threshold value. They are organized in a
 list for multiprocessing purpose.
 """
 
+import os.path
+import warnings
 import numpy as np
 # from scipy.ndimage import filters
-from scipy.ndimage import gaussian_filter, laplace
-from scipy.stats import norm
-from skimage.measure import label, regionprops  # , regionprops_table
+from scipy.ndimage import gaussian_filter
+from scipy import ndimage
+from scipy import fft as sp_fft
+# from scipy.stats import norm
+from skimage.measure import label  # , regionprops, regionprops_table
 from skimage.morphology import binary_dilation
 
-import SpotsDetectionUtility
+import SharedArrays
+import SpotsCoordsBuilder
+
+
+SCRATCH  =  {}                                                                       # per process scratch volumes of the frame filtering, reused frame after frame
+
+
+def scratch_buffers(shape, dtype):
+    """Preallocated volumes for the filtering of a frame (gaussian, laplacian, laplacian term, threshold mask and labels): created once per process and frame shape."""
+    key  =  (tuple(shape), np.dtype(dtype).str)
+    if key not in SCRATCH:
+        SCRATCH.clear()                                                              # a single frame shape at the time: no need to keep the old ones
+        SCRATCH[key]  =  [np.empty(shape, dtype=dtype), np.empty(shape, dtype=np.float32), np.empty(shape, dtype=np.float32), np.empty(shape, dtype=bool), np.empty(shape, dtype=np.int32)]
+    return SCRATCH[key]
+
+
+def thr_stats(data, thr_val, buff=None, n_sample=0):
+    """Threshold mu + thr_val * sigma, with mu and sigma of a Gaussian fitted on data: same values of norm.fit, or estimated on n_sample random voxels if n_sample > 0."""
+    if 0 < n_sample < data.size:
+        smp    =  data.ravel()[np.random.default_rng(0).integers(0, data.size, n_sample)]      # fixed seed: same frame gives the same threshold
+        mu     =  smp.mean(dtype=np.float64)
+        sigma  =  smp.std(dtype=np.float64)
+    else:
+        mu  =  data.mean()                                                           # explicit formulas of norm.fit (maximum likelihood), without its checks and temporary copies
+        if buff is None:
+            buff  =  np.empty_like(data)
+        np.subtract(data, mu, out=buff)
+        np.square(buff, out=buff)
+        sigma  =  np.sqrt(buff.mean())
+    return mu + thr_val * sigma
+
+
+def spts_int_vol_vect(a, raw, i_in, with_tags=True):
+    """Single pass version of SpotsDetectionUtility.spts_int_vol: same outputs, cost independent of the number of spots. The 3D matrix of the good spots is built only with with_tags (None otherwise)."""
+    lut        =  np.zeros(a.max() + 1, dtype=bool)                                  # lookup table of the tags: True for the tags to keep
+    lut[i_in]  =  True
+    msk        =  lut[a]                                                             # 3D mask of the pixels of the good spots
+    s          =  msk.sum(0, dtype=np.int64)                                         # volume summed in z
+    d          =  (raw * msk).sum(0, dtype=np.int64)                                 # intensity summed in z (raw data in their native dtype, no copy)
+    g          =  a * msk if with_tags else None                                     # 3D matrix of the good spots with their tags
+    return s, d, g
+
+
+def spts_int_vol(a, raw, i_in, int_vol_engine="vect", with_tags=True):
+    """Choose the engine to measure intensity and volume of the spots: 'vect' (numpy lookup table) or 'cython' (original kernel, compiled module imported only here)."""
+    if int_vol_engine == "cython":
+        import SpotsDetectionUtility
+        return SpotsDetectionUtility.spts_int_vol(a.astype(np.int64), raw.astype(np.int64), np.asarray(i_in, dtype=np.int64).tolist())
+    return spts_int_vol_vect(a, raw, i_in, with_tags)
+
+
+def label_stats(lbls, volume_thr_var):
+    """Volume and z extension of all the labels at once: output are the tags of the spots bigger than volume_thr_var present in more than one z plane and the z-x-y coordinates of their pixels (grouped by tag)."""
+    flat    =  lbls.ravel()
+    idxs    =  np.flatnonzero(flat)                                                  # raster index of the labelled pixels
+    tags    =  flat[idxs]
+    order   =  np.argsort(tags, kind="stable")                                       # pixels grouped by tag, each group keeps the raster order (z increasing)
+    idxs    =  idxs[order]
+    tags    =  tags[order]
+    counts  =  np.bincount(tags, minlength=lbls.max() + 1)                            # volume of each tag
+    ends    =  np.cumsum(counts)
+    starts  =  ends - counts
+    zs      =  idxs // (lbls.shape[1] * lbls.shape[2])
+    z_ext   =  np.zeros(counts.size, dtype=bool)
+    full    =  counts > 0
+    z_ext[full]  =  zs[ends[full] - 1] > zs[starts[full]]                           # last z bigger than the first one: the spot is present in more than one z plane
+    good    =  (counts > volume_thr_var) & z_ext                                    # tag 0 (background) has no pixels here, so it is never good
+    coords  =  np.column_stack(np.unravel_index(idxs[good[tags]], lbls.shape))
+    return np.flatnonzero(good), coords
+
+
+FILTER_BACKENDS  =  ["gauss_lapl", "log", "fft"]
+LOG_MIN_SIGMA    =  0.5                                                             # below half a pixel the sampled second derivative of gaussian_laplace degenerates
+
+
+def read_filter_backend():
+    """Read the filter backend setting ('filter_backend.npy', 'gauss_lapl' if missing)."""
+    if os.path.isfile('filter_backend.npy'):
+        return str(np.load('filter_backend.npy'))
+    return "gauss_lapl"
+
+
+def filter_sigmas(g_kern, pix_sizes=None):
+    """Gaussian sigma in pixels along z, x, y: g_kern along x and y, the same physical size along z if pix_sizes (pix_size_z, pix_size_xy) are known."""
+    if pix_sizes is None or not pix_sizes[0] or not pix_sizes[1]:
+        return np.array([g_kern, g_kern, g_kern], dtype=np.float64)
+    return np.array([g_kern * pix_sizes[1] / pix_sizes[0], g_kern, g_kern], dtype=np.float64)
+
+
+def log_sigmas(g_kern, pix_sizes=None):
+    """Sigmas of the 'log' backend: the ones of filter_sigmas, with only the axes below LOG_MIN_SIGMA raised to it (and a warning when it happens)."""
+    sigmas   =  filter_sigmas(g_kern, pix_sizes)
+    clamped  =  np.maximum(sigmas, LOG_MIN_SIGMA)
+    if np.any(clamped != sigmas):
+        warnings.warn("'log' filter: sigmas (z, x, y) %s pixels raised to %s, use the 'fft' backend to keep them" % (np.round(sigmas, 3).tolist(), np.round(clamped, 3).tolist()))
+    return clamped
+
+
+def log_fft(g21, sigmas, out):
+    """Gaussian filter followed by the discrete laplacian in a single product in the Fourier space: cost does not depend on the kernel size."""
+    pads    =  [int(4 * sg + 0.5) + 1 for sg in sigmas]                                                                # mirror padding against the periodic boundary of the FFT
+    shp     =  [sp_fft.next_fast_len(ln + 2 * pd, real=True) for ln, pd in zip(g21.shape, pads)]
+    g21p    =  np.pad(g21.astype(np.float32), [(pd, sh - ln - pd) for ln, pd, sh in zip(g21.shape, pads, shp)], mode="symmetric")
+    spctr   =  sp_fft.rfftn(g21p)
+    g_trsf  =  np.ones(1, dtype=np.float32)                                                                            # transfer function of the gaussian
+    l_trsf  =  np.zeros(1, dtype=np.float32)                                                                           # transfer function of the discrete laplacian
+    for ax, (sh, sg) in enumerate(zip(shp, sigmas)):
+        ww       =  2 * np.pi * (sp_fft.rfftfreq(sh) if ax == len(shp) - 1 else sp_fft.fftfreq(sh))
+        ww       =  ww.reshape([-1 if k == ax else 1 for k in range(len(shp))])
+        g_trsf   =  g_trsf * np.exp(-.5 * (sg * ww) ** 2).astype(np.float32)
+        l_trsf   =  l_trsf + (2 * np.cos(ww) - 2).astype(np.float32)
+    spctr  *=  g_trsf * l_trsf
+    out[:]  =  sp_fft.irfftn(spctr, s=shp)[tuple(slice(pd, pd + ln) for pd, ln in zip(pads, g21.shape))]
+
+
+def frame_filter(g21, g_kern, filter_backend, pix_sizes, g21g, g21f, g21f_ax):
+    """Fill g21f with the Laplacian of Gaussian of the frame. filter_backend is 'gauss_lapl' (gaussian in the raw data dtype and discrete laplacian, the original isotropic filter), 'log' (scipy gaussian_laplace) or 'fft' (Fourier space); the last two use the anisotropic sigma of filter_sigmas. 'log' sigmas below LOG_MIN_SIGMA are raised to it, axis by axis (see log_sigmas): for thinner kernels use 'fft', which keeps the discrete laplacian."""
+    if filter_backend == "log":
+        ndimage.gaussian_laplace(g21, log_sigmas(g_kern, pix_sizes), output=g21f)
+    elif filter_backend == "fft":
+        log_fft(g21, filter_sigmas(g_kern, pix_sizes), g21f)
+    else:
+        # g21g         =  filters.gaussian_filter(g21, float(g_kern))
+        gaussian_filter(g21, float(g_kern), output=g21g)                         # we Gaussian filter the 3D stack (x-y-z) and then Laplacian filter; gaussian stays in the raw data dtype, as it always did
+        ndimage.correlate1d(g21g, [1, -2, 1], 0, output=g21f)                    # float32 laplacian, same operations of scipy laplace but without temporary volumes
+        for ax in range(1, g21.ndim):
+            ndimage.correlate1d(g21g, [1, -2, 1], ax, output=g21f_ax)
+            g21f  +=  g21f_ax
+
+
+def spots_detection_frame(g21, t, thr_val, volume_thr_var, g_kern, int_vol_engine="vect", thr_sample=0, filter_backend="gauss_lapl", pix_sizes=None):
+    """Detect spots in a single 3D (z-x-y) time frame: output are intensity and volume summed in z and the t-z-x-y coordinates of the spots pixels."""
+    coords_bld  =  SpotsCoordsBuilder.SpotsCoordsBuilder()                       # coordinates of the spots pixels, joined once at the end
+
+    g21g, g21f, g21f_ax, g21f_thr, g21f3dlbl  =  scratch_buffers(g21.shape, g21.dtype)
+
+    frame_filter(g21, g_kern, filter_backend, pix_sizes, g21g, g21f, g21f_ax)
+    np.abs(g21f, out=g21f)                                                       # only the absolute value is used
+    np.greater(g21f, thr_stats(g21f, thr_val, g21f_ax, thr_sample), out=g21f_thr)     # histogram is fitted with a Gaussian function and thresholded
+    ndimage.label(g21f_thr, structure=np.ones((3, 3, 3)), output=g21f3dlbl)      # labelling (full connectivity, as skimage label)
+
+    i_in, zxy  =  label_stats(g21f3dlbl, volume_thr_var)                          # tags of spots that satisfies the conditions (volume and z planes) and their pixels
+    zz         =  spts_int_vol(g21f3dlbl, g21, i_in, int_vol_engine, with_tags=False)     # spot intensity and volume summed in z (the 3D spots matrix is not needed here)
+    coords_bld.append_frame(t, zxy)
+
+    return zz[1], zz[0], coords_bld.array()
 
 
 class SpotsDetection3D:
@@ -22,54 +171,64 @@ class SpotsDetection3D:
         green4D         =  in_args[0]
         thr_val         =  in_args[1]
         volume_thr_var  =  in_args[2]
-        g_kern          =  np.load('gauss_kern_size.npy')
+        int_vol_engine  =  in_args[3]                                           # engine to measure spots intensity and volume ('vect' or 'cython')
+        g_kern          =  in_args[4]                                           # gaussian kernel size, given by the caller (no settings file is read here)
+        t_first         =  in_args[5] if len(in_args) > 5 else 0                # time value of the first frame (for the spots coordinates)
+        thr_sample      =  in_args[6] if len(in_args) > 6 else 0                # number of random voxels to estimate the threshold (0 means all the voxels)
+        filter_backend  =  in_args[7] if len(in_args) > 7 else "gauss_lapl"     # filter of the frames ('gauss_lapl', 'log' or 'fft')
+        pix_sizes       =  in_args[8] if len(in_args) > 8 else None             # pixel sizes (z, xy) for the anisotropic filters
 
         steps, zlen, xlen, ylen  =  green4D.shape
 
         spots_ints    =  np.zeros((steps, xlen, ylen), dtype=np.int32)
         spots_vol     =  np.zeros((steps, xlen, ylen), dtype=np.int8)
-        spots_coords  =  np.zeros((0, 4), dtype=np.int16)
+        coords_bld    =  SpotsCoordsBuilder.SpotsCoordsBuilder()
         # spots_lbls    =  np.zeros((steps, zlen, xlen, ylen), dtype=np.int16)
         # spots_tzxy    =  np.zeros((0, 4), dtype=np.int16)
 
         for t in range(steps):
-            # print(t)
-            g21          =  green4D[t, :, :, :]                                           # for each time step, we Gaussian filter the 3D stack (x-y-z) and then Laplacian filter
-            # g21g         =  filters.gaussian_filter(g21, float(g_kern))
-            g21g         =  gaussian_filter(g21, float(g_kern))
-            g21f         =  laplace(g21g.astype(np.float32))
-            (mu, sigma)  =  norm.fit(np.abs(g21f))                                        # histogram is fitted with a Gaussian function
-            g21f_thr     =  np.abs(g21f) > mu + thr_val * sigma                           # thresholding on the histogram
-            g21f3dlbl    =  label(g21f_thr)                                               # labelling
-
-            i_in       =  []                                                              # tags of spots that satisfies the conditions (volume and z planes)
-            i_out      =  []                                                              # tags of spots that don't satisfy the conditions
-            rgp_discr  =  regionprops(g21f3dlbl)
-            for k in range(len(rgp_discr)):
-                if rgp_discr[k]['area'] > volume_thr_var and np.diff(np.sort(rgp_discr[k]['coords'][:, 0])).sum() > 0:     # in 3D 'area' is volume; with 'coords' we plot all the values of the z coordinates of all the pixels.
-                    i_in.append(rgp_discr[k]['label'])                                                                     # then we calculate the sum of the derivative: if it is zero, the spot is present only in una z-frame, so it is removed
-                    # spots_tzxy  =  np.concatenate([spots_tzxy, [np.append(t, np.round(np.asarray(rgp_discr[k]['centroid'])).astype(np.int))]], axis=0)    # coordinates of the good spots
-                else:
-                    i_out.append(rgp_discr[k]['label'])
-
-            zz              =  SpotsDetectionUtility.spts_int_vol(g21f3dlbl.astype(np.int64), g21.astype(np.int64), i_in)             # output are 3 matrices: spot intensity summed in z, volume summed in z and 3D spots to remove
-            spots_ints[t]  +=  zz[1]
-            spots_vol[t]   +=  zz[0].astype(np.int8)
-            # spots_lbls[t]  +=  zz[2].astype(np.int16)
-            rgp            =  regionprops(zz[2])
-            # rgp_spts_lbls  =  regionprops_table(zz[2], properties=["label", "coors"])
-            # coords_bff  =  np.zeros((0, 3), np.int16)
-            for rr in rgp:
-                # coords_bff  =   np.concatenate((coords_bff, rr['coords']), axis=0)
-
-                spots_coords  =  np.concatenate((spots_coords, np.column_stack((t * np.ones(rr['coords'].shape[0], dtype=np.int16), rr['coords']))), axis=0)
-            # spots_coords.append(coords_bff)
+            ints_fr, vol_fr, coords_fr  =  spots_detection_frame(green4D[t, :, :, :], t_first + t, thr_val, volume_thr_var, g_kern, int_vol_engine, thr_sample, filter_backend, pix_sizes)
+            spots_ints[t]              +=  ints_fr
+            spots_vol[t]               +=  vol_fr.astype(np.int8)
+            coords_bld.append(coords_fr)
 
         self.spots_ints    =  spots_ints
         self.spots_vol     =  spots_vol
         # self.spots_tzxy    =  spots_tzxy
         # self.spots_lbls    =  spots_lbls
-        self.spots_coords  =  spots_coords
+        self.spots_coords  =  coords_bld.array()
+        self.t_first       =  t_first
+
+
+class SpotsDetection3DShared:
+    """Class working on several time frames of a 4D matrix memory mapped on a file: the worker receives only the frame indexes."""
+    def __init__(self, in_args):
+
+        green4D         =  SharedArrays.MmapArrayAttach(in_args[0])             # raw data are mapped from their file, spots intensity and spots volume matrices are attached by name
+        spots_ints      =  SharedArrays.SharedArrayAttach(in_args[1])
+        spots_vol       =  SharedArrays.SharedArrayAttach(in_args[2])
+        t_steps         =  in_args[3]                                           # frames to work on
+        thr_val         =  in_args[4]
+        volume_thr_var  =  in_args[5]
+        int_vol_engine  =  in_args[6]
+        g_kern          =  in_args[7]
+        thr_sample      =  in_args[8]
+        filter_backend  =  in_args[9]
+        pix_sizes       =  in_args[10]
+
+        coords_bld  =  SpotsCoordsBuilder.SpotsCoordsBuilder()
+        for t in t_steps:
+            ints_fr, vol_fr, coords_fr  =  spots_detection_frame(green4D.arr[t], t, thr_val, volume_thr_var, g_kern, int_vol_engine, thr_sample, filter_backend, pix_sizes)
+            spots_ints.arr[t]           =  ints_fr                                              # results are written directly in the shared output matrices
+            spots_vol.arr[t]            =  vol_fr
+            coords_bld.append(coords_fr)
+
+        green4D.close()
+        spots_ints.close()
+        spots_vol.close()
+
+        self.spots_coords  =  coords_bld.array()        # only the coordinates (small) travel back to the main process
+        self.t_steps       =  t_steps
 
 
 class SpotsDetection3D_Single:
@@ -79,30 +238,26 @@ class SpotsDetection3D_Single:
         green4D         =  in_args[0]
         thr_val         =  in_args[1]
         volume_thr_var  =  in_args[2]
+        int_vol_engine  =  in_args[3]
+        thr_sample      =  in_args[4]
+        g_kern          =  in_args[5]
+        filter_backend  =  in_args[6] if len(in_args) > 6 else "gauss_lapl"
+        pix_sizes       =  in_args[7] if len(in_args) > 7 else None
 
         zlen, xlen, ylen  =  green4D.shape
 
         spots_ints   =  np.zeros((xlen, ylen))
         spots_vol    =  np.zeros((xlen, ylen))
         g21          =  green4D                                                                    # for each time step, we Gaussian filter the 3D stack (x-y-z) and than Laplacian filter
-        g21g         =  gaussian_filter(g21, 1)
-        g21f         =  laplace(g21g.astype(float))
-        (mu, sigma)  =  norm.fit(np.abs(g21f))                                                                      # histogram is fitted with a Gaussian function
-        g21f_thr     =  np.abs(g21f) > mu + thr_val * sigma                                                    # thresholding on the histogram
+        g21g, g21f, g21f_ax  =  scratch_buffers(g21.shape, g21.dtype)[:3]
+        frame_filter(g21, g_kern, filter_backend, pix_sizes, g21g, g21f, g21f_ax)                  # same filter of the detection
+        g21f         =  np.abs(g21f)
+        g21f_thr     =  g21f > thr_stats(g21f, thr_val, None, thr_sample)                                            # histogram is fitted with a Gaussian function and thresholded
         g21f3dlbl    =  label(g21f_thr)                                                                             # labelling
-        g2show       =  np.zeros(g21f3dlbl.shape)
-
-        i_in       =  []                                                              # tags of spots that satisfies the conditions (volume and z planes)
-        i_out      =  []                                                              # tags of spots that don't satisfy the conditions
-        rgp_discr  =  regionprops(g21f3dlbl)
-        for k in range(len(rgp_discr)):
-            if rgp_discr[k]['area'] > volume_thr_var and np.diff(np.sort(rgp_discr[k]['coords'][:, 0])).sum() > 0:     # in 3D 'area' is volume; with 'coords' we plot all the values of the z coordinates of all the pixels.
-                i_in.append(rgp_discr[k]['label'])                                                                     # then we and calculate the sum of the derivative: if it is zero, and one z and and so on
-                g2show  +=  g21f3dlbl == rgp_discr[k]['label']
-            else:
-                i_out.append(rgp_discr[k]['label'])
-
-        zz           =  SpotsDetectionUtility.spts_int_vol(g21f3dlbl.astype(np.int64), g21.astype(np.int64), i_in)             # output are 3 matrices: spot intensity summed in z, volume summed in z and 3D spots to remove
+
+        i_in, _      =  label_stats(g21f3dlbl, volume_thr_var)                                                               # tags of spots that satisfies the conditions (volume and z planes)
+        zz           =  spts_int_vol(g21f3dlbl, g21, i_in, int_vol_engine)                                                   # output are 3 matrices: spot intensity summed in z, volume summed in z and 3D spots to remove
+        g2show       =  np.sign(zz[2])
         spots_ints  +=  zz[1]
         spots_vol   +=  zz[0]
 
@@ -119,31 +274,26 @@ class SpotsDetection3D_Single4Test:
         thr_val         =  in_args[1]
         volume_thr_var  =  in_args[2]
         merge_radius    =  in_args[3]
-        g_kern          =  np.load('gauss_kern_size.npy')
+        int_vol_engine  =  in_args[4]
+        thr_sample      =  in_args[5]
+        g_kern          =  in_args[6]
+        filter_backend  =  in_args[7] if len(in_args) > 7 else "gauss_lapl"
+        pix_sizes       =  in_args[8] if len(in_args) > 8 else None
         # print("outside")
         zlen, xlen, ylen  =  green4D.shape
 
         spots_ints   =  np.zeros((xlen, ylen))
         spots_vol    =  np.zeros((xlen, ylen))
         g21          =  green4D                                                                    # for each time step, we Gaussian filter the 3D stack (x-y-z) and than Laplacian filter
-        g21g         =  gaussian_filter(g21, float(g_kern))
-        g21f         =  laplace(g21g.astype(float))
-        (mu, sigma)  =  norm.fit(np.abs(g21f))                                                     # histogram is fitted with a Gaussian function
-        g21f_thr     =  np.abs(g21f) > mu + thr_val * sigma                                        # thresholding on the histogram
+        g21g, g21f, g21f_ax  =  scratch_buffers(g21.shape, g21.dtype)[:3]
+        frame_filter(g21, g_kern, filter_backend, pix_sizes, g21g, g21f, g21f_ax)                  # same filter of the detection, so the test shows what the detection will find
+        g21f         =  np.abs(g21f)
+        g21f_thr     =  g21f > thr_stats(g21f, thr_val, None, thr_sample)                          # histogram is fitted with a Gaussian function and thresholded
         g21f3dlbl    =  label(g21f_thr)                                                            # labelling
-        g2show       =  np.zeros(g21f3dlbl.shape)
-
-        i_in       =  []                                                              # tags of spots that satisfies the conditions (volume and z planes)
-        i_out      =  []                                                              # tags of spots that don't satisfy the conditions
-        rgp_discr  =  regionprops(g21f3dlbl)
-        for k in range(len(rgp_discr)):
-            if rgp_discr[k]['area'] > volume_thr_var and np.diff(np.sort(rgp_discr[k]['coords'][:, 0])).sum() > 0:     # in 3D 'area' is volume; with 'coords' we plot all the values of the z coordinates of all the pixels.
-                i_in.append(rgp_discr[k]['label'])                                                                     # then we and calculate the sum of the derivative: if it is zero, and one z and and so on
-                g2show  +=  g21f3dlbl == rgp_discr[k]['label']
-            else:
-                i_out.append(rgp_discr[k]['label'])
-
-        zz           =  SpotsDetectionUtility.spts_int_vol(g21f3dlbl.astype(np.int64), g21.astype(np.int64), i_in)             # output are 3 matrices: spot intensity summed in z, volume summed in z and 3D spots to remove
+
+        i_in, _      =  label_stats(g21f3dlbl, volume_thr_var)                                                               # tags of spots that satisfies the conditions (volume and z planes)
+        zz           =  spts_int_vol(g21f3dlbl, g21, i_in, int_vol_engine)                                                   # output are 3 matrices: spot intensity summed in z, volume summed in z and 3D spots to remove
+        g2show       =  np.sign(zz[2])
         spots_ints  +=  zz[1]
         spots_vol   +=  zz[0]
 
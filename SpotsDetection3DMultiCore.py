@@ -1,60 +1,80 @@
 """This function detects spots of the 4D (time-x-y-z) stack.
 
-This manages the detection in a multiprocessing implementation.
+This manages the detection in a multiprocessing implementation: each frame is a
+task of the pool, so the workers stay busy even if the cost of the frames varies.
+With shm_flag, a 4D stack memory mapped on a file (the stacks the GUI loads, stored in
+a temporary file with mmap_path, or a raw data cache entry) is mapped by the workers
+themselves: they receive only frame indexes and write spots intensity and volume
+directly in shared output matrices. Any other stack is sent frame by frame to the
+workers, so the stack is never duplicated.
+Progress is reported frame by frame to progress_callback(done, total), if given.
 """
 
 from importlib import reload
-import multiprocessing
 import numpy as np
 
 import SpotsDetection3D
+import SharedArrays
+import SpotsCoordsBuilder
+import WorkersPool
 
 
 class SpotsDetection3DMultiCore:
     """Only class, does all the job."""
-    def __init__(self, green4D, spots3D_thr, vol_thr):
+    def __init__(self, green4D, spots3D_thr, vol_thr, g_kern, workers, int_vol_engine="vect", shm_flag=True, thr_sample=0, filter_backend="gauss_lapl", pix_sizes=None, progress_callback=None):
 
         reload(SpotsDetection3D)
-        cpu_ow   =  multiprocessing.cpu_count()
-        if green4D.shape[0] > cpu_ow:
-            t_chops  =  1 + green4D.shape[0] // cpu_ow
-
-            a  =  []
-            for t in range(cpu_ow - 1):
-                a.append(green4D[t * t_chops:(t + 1) * t_chops, :, :, :])           # in the multiprocessing pool each core will work on a certain number of frames: here we chop the frames
-
-            a.append(green4D[(t + 1) * t_chops:, :, :, :])
-            job_args  =  []
-            for k in range(cpu_ow):
-                job_args.append([a[k], spots3D_thr, vol_thr])
-
-            pool     =  multiprocessing.Pool()
-            results  =  pool.map(SpotsDetection3D.SpotsDetection3D, job_args)
-            pool.close()
-
-            spots_ints    =  results[0].spots_ints
-            spots_vol     =  results[0].spots_vol
-            # spots_lbls    =  results[0].spots_lbls
-            spots_coords  =  results[0].spots_coords
-            # spots_tzxy    =  results[0].spots_tzxy
-            for k in range(1, len(results)):
-                if results[k].spots_vol.shape[0] != 0:
-                    spots_ints    =  np.concatenate((spots_ints, results[k].spots_ints), axis=0)
-                    spots_vol     =  np.concatenate((spots_vol, results[k].spots_vol), axis=0)
-                    # spots_lbls    =  np.concatenate((spots_lbls, results[k].spots_lbls), axis=0)
-                    spots_coords  =  np.concatenate([spots_coords, results[k].spots_coords + np.array([t_chops * k, 0, 0, 0])], axis=0)
-                    # spots_tzxy    =  np.concatenate((spots_tzxy, results[k].spots_tzxy + np.array([t_chops * k, 0, 0, 0])), axis=0)
+        cpu_ow                   =  workers                                        # settings are read by the caller, g_kern is sent to the workers as it is
+        steps, zlen, xlen, ylen  =  green4D.shape
+        coords_frs               =  [None] * steps                                 # spots coordinates of each frame, reassembled in time order
+        coords_bld               =  SpotsCoordsBuilder.SpotsCoordsBuilder()
+
+        green_desc               =  SharedArrays.mmap_desc(green4D) if shm_flag else None     # None if the stack is not on a file
+
+        if steps > 1 and cpu_ow > 1 and green_desc is not None:
+            spots_ints_shm  =  SharedArrays.SharedArray((steps, xlen, ylen), np.int32)
+            spots_vol_shm   =  SharedArrays.SharedArray((steps, xlen, ylen), np.int8)
+            try:
+                job_args  =  ([green_desc, spots_ints_shm.desc, spots_vol_shm.desc, [t], spots3D_thr, vol_thr, int_vol_engine, g_kern, thr_sample, filter_backend, pix_sizes] for t in range(steps))     # one task per frame: a free worker takes the next frame, whatever the cost of the others
+                for cnt, res in enumerate(WorkersPool.get_pool(cpu_ow).imap_unordered(SpotsDetection3D.SpotsDetection3DShared, job_args)):
+                    coords_frs[res.t_steps[0]]  =  res.spots_coords
+                    if progress_callback is not None:
+                        progress_callback(cnt + 1, steps)
+
+                self.spots_ints    =  spots_ints_shm.arr.copy()
+                self.spots_vol     =  spots_vol_shm.arr.copy()
+                for coords_fr in coords_frs:
+                    coords_bld.append(coords_fr)
+                self.spots_coords  =  coords_bld.array()
+
+            finally:
+                spots_ints_shm.release()
+                spots_vol_shm.release()
+
+        elif steps > 1 and cpu_ow > 1:
+            spots_ints  =  np.zeros((steps, xlen, ylen), dtype=np.int32)
+            spots_vol   =  np.zeros((steps, xlen, ylen), dtype=np.int8)
+
+            job_args  =  ([green4D[t][np.newaxis], spots3D_thr, vol_thr, int_vol_engine, g_kern, t, thr_sample, filter_backend, pix_sizes] for t in range(steps))      # one task per frame, frames are pickled one by one by the pool
+            for cnt, res in enumerate(WorkersPool.get_pool(cpu_ow).imap_unordered(SpotsDetection3D.SpotsDetection3D, job_args)):
+                spots_ints[res.t_first]  =  res.spots_ints[0]                       # results arrive in any order, each one goes in its place
+                spots_vol[res.t_first]   =  res.spots_vol[0]
+                coords_frs[res.t_first]  =  res.spots_coords
+                if progress_callback is not None:
+                    progress_callback(cnt + 1, steps)
 
             self.spots_ints    =  spots_ints
             self.spots_vol     =  spots_vol
-            # self.spots_lbls    =  spots_lbls
-            self.spots_coords  =  spots_coords
-            # self.spots_tzxy    =  spots_tzxy
+            for coords_fr in coords_frs:
+                coords_bld.append(coords_fr)
+            self.spots_coords  =  coords_bld.array()
 
         else:
-            spots_buff         =  SpotsDetection3D.SpotsDetection3D([green4D, spots3D_thr, vol_thr])
+            spots_buff         =  SpotsDetection3D.SpotsDetection3D([green4D, spots3D_thr, vol_thr, int_vol_engine, g_kern, 0, thr_sample, filter_backend, pix_sizes])
             self.spots_ints    =  spots_buff.spots_ints
             self.spots_vol     =  spots_buff.spots_vol
             # self.spots_lbls    =  spots_buff.spots_lbls
             self.spots_coords  =  spots_buff.spots_coords
+            if progress_callback is not None:
+                progress_callback(steps, steps)
             # self.spots_tzxy    =  spots_buff.spots_tzxy
@@ -1,58 +1,33 @@
 """This function performs 3D spots detection on a time series.
 
-In order to avoid memory errors (very long time series) this function chops the
-stack and works on pieces. Results are concatenated in order to have a single
-output relative to the entire input matrix.
+Detection is dispatched frame by frame to the workers (see SpotsDetection3DMultiCore),
+so even very long time series do not need to be chopped in pieces. Detected spots
+are then labelled in 2D and, if required, close fragments are merged.
 """
 
 from importlib import reload
-import multiprocessing
 import numpy as np
 from skimage.measure import label
 from skimage.morphology import binary_dilation
 
 import SpotsDetection3DMultiCore
+import SpotsCoordsBuilder
 
 
 class SpotsDetectionChopper:
     """Main class, does all the job."""
-    def __init__(self, green4D, spots_thr_value, volume_thr_value, merge_radius):
+    def __init__(self, green4D, spots_thr_value, volume_thr_value, merge_radius, g_kern, workers, int_vol_engine="vect", shm_flag=True, thr_sample=0, filter_backend="gauss_lapl", pix_sizes=None, progress_callback=None):
         reload(SpotsDetection3DMultiCore)
         spts_clean  =  None
         steps       =  green4D.shape[0]
-        cpu_owe     =  multiprocessing.cpu_count()
-        chop        =  cpu_owe * 3
 
-        if steps > chop:
-            n_chops       =  steps // chop
-            spots_ints    =  np.zeros((0, green4D.shape[2], green4D.shape[3]), dtype=int)
-            spots_vol     =  np.zeros((0, green4D.shape[2], green4D.shape[3]), dtype=np.int8)
-            # spots_lbls    =  np.zeros((0, green4D.shape[1], green4D.shape[2], green4D.shape[3]), dtype=np.int16)
-            spots_coords  =  np.zeros((0, 4), dtype=np.int16)
-            # spots_tzxy    =  np.zeros((0, 4), dtype=np.int16)
-
-            for nc in range(n_chops):
-                spots_3D      =  SpotsDetection3DMultiCore.SpotsDetection3DMultiCore(green4D[chop * nc:chop * (nc + 1), :, :, :], spots_thr_value, volume_thr_value)
-                spots_ints    =  np.concatenate([spots_ints, spots_3D.spots_ints], axis=0)
-                spots_vol     =  np.concatenate([spots_vol, spots_3D.spots_vol], axis=0)
-                # spots_lbls    =  np.concatenate([spots_lbls, spots_3D.spots_lbls], axis=0)
-                spots_coords  =  np.concatenate((spots_coords, spots_3D.spots_coords + np.array([nc * chop, 0, 0, 0])), axis=0)
-                # spots_tzxy    =  np.concatenate([spots_tzxy, spots_3D.spots_tzxy + np.array([nc * chop, 0, 0, 0])], axis=0)
-
-            spots_3D      =  SpotsDetection3DMultiCore.SpotsDetection3DMultiCore(green4D[chop * (nc + 1):, :, :], spots_thr_value, volume_thr_value)
-            spots_ints    =  np.concatenate([spots_ints, spots_3D.spots_ints], axis=0)
-            spots_vol     =  np.concatenate([spots_vol, spots_3D.spots_vol], axis=0)
-            # spots_lbls    =  np.concatenate([spots_lbls, spots_3D.spots_lbls], axis=0)
-            spots_coords  =  np.concatenate([spots_coords, spots_3D.spots_coords + np.array([(nc + 1) * chop, 0, 0, 0])], axis=0)
-            # spots_tzxy    =  np.concatenate([spots_tzxy, spots_3D.spots_tzxy + np.array([(nc + 1) * chop, 0, 0, 0])], axis=0)
-
-        else:
-            spots_3D      =  SpotsDetection3DMultiCore.SpotsDetection3DMultiCore(green4D, spots_thr_value, volume_thr_value)
-            spots_ints    =  spots_3D.spots_ints
-            spots_vol     =  spots_3D.spots_vol
-            # spots_lbls    =  spots_3D.spots_lbls
-            spots_coords  =  spots_3D.spots_coords
-            # spots_tzxy    =  spots_3D.spots_tzxy
+        spots_3D      =  SpotsDetection3DMultiCore.SpotsDetection3DMultiCore(green4D, spots_thr_value, volume_thr_value, g_kern, workers, int_vol_engine, shm_flag, thr_sample, filter_backend, pix_sizes, progress_callback)     # frames are dispatched one by one, no need to chop the stack
+        spots_ints    =  spots_3D.spots_ints
+        spots_vol     =  spots_3D.spots_vol
+        # spots_lbls    =  spots_3D.spots_lbls
+        coords_bld    =  SpotsCoordsBuilder.SpotsCoordsBuilder()
+        coords_bld.append(spots_3D.spots_coords)
+        # spots_tzxy    =  spots_3D.spots_tzxy
 
         spots_2d_lbls  =  np.zeros_like(spots_ints)
         t_steps        =  spots_2d_lbls.shape[0]
@@ -73,5 +48,6 @@ class SpotsDetectionChopper:
         self.spots_vol      =  spots_vol
         # self.spots_tzxy     =  spots_tzxy
         # self.spots_lbls     =  spots_lbls
-        self.spots_coords   =  np.concatenate([spots_coords, np.array([[steps, green4D.shape[1], green4D.shape[2], green4D.shape[3]]])])
+        coords_bld.append([[steps, green4D.shape[1], green4D.shape[2], green4D.shape[3]]])                     # last row gives info on the raw data size
+        self.spots_coords   =  coords_bld.array()
         self.spots_2d_lbls  =  spts_clean
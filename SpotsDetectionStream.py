@@ -0,0 +1,67 @@
+"""This function performs 3D spots detection on a time series read frame by frame.
+
+Frames come from an iterator (for instance LoadRawData.CziFramesReader.frames, which
+decodes the .czi files one time frame at the time), so the 4D stack never stays in
+memory: each frame is detected in the workers pool and results are written straight
+away in matrices on the disk. It is meant for acquisitions that do not fit in memory,
+run from a script rather than from the GUI: frames come from CziFramesReader.frames or
+TiffFramesReader.frame, and the output matrices (memory mapped) go to SpotsTracker as
+the SpotsDetectionChopper ones.
+With merge_radius = 0 outputs are the same of SpotsDetectionChopper. With merge_radius > 0
+spots_2d_lbls differ: here the dilated spots are labelled in 2D, frame by frame (labels
+start from 1 in each frame and fragments are merged only inside their frame), while
+SpotsDetectionChopper labels the dilated stack in 3D, so its labels are unique in the
+whole stack and fragments touching in consecutive frames share their label.
+"""
+
+import os
+import numpy as np
+from skimage.measure import label
+from skimage.morphology import binary_dilation
+
+import SpotsDetection3D
+import WorkersPool
+
+
+class SpotsDetectionStream:
+    """Main class, does all the job."""
+    def __init__(self, frames, tlen, frame_shape, spots_thr_value, volume_thr_value, merge_radius, out_folder, g_kern, workers, int_vol_engine="vect", thr_sample=0, filter_backend="gauss_lapl", pix_sizes=None, progress_callback=None):
+
+        zlen, xlen, ylen  =  frame_shape
+
+        spots_ints     =  np.lib.format.open_memmap(out_folder + '/spots_ints_stream.npy', mode='w+', dtype=np.int32, shape=(tlen, xlen, ylen))      # outputs are matrices on the disk
+        spots_vol      =  np.lib.format.open_memmap(out_folder + '/spots_vol_stream.npy', mode='w+', dtype=np.int8, shape=(tlen, xlen, ylen))
+        spots_2d_lbls  =  np.lib.format.open_memmap(out_folder + '/spots_2d_lbls_stream.npy', mode='w+', dtype=np.int32, shape=(tlen, xlen, ylen))
+
+        n_coords  =  0
+        with open(out_folder + '/spots_coords_stream.bin', 'wb') as coords_file:                                  # coordinates are appended frame by frame
+            job_args  =  ([frame[np.newaxis], spots_thr_value, volume_thr_value, int_vol_engine, g_kern, t, thr_sample, filter_backend, pix_sizes] for t, frame in enumerate(frames))
+            for res in WorkersPool.get_pool(workers).imap(SpotsDetection3D.SpotsDetection3D, job_args):                 # frames are decoded and sent to the workers one by one, results arrive in time order
+                tt                 =  res.t_first
+                spots_ints[tt]     =  res.spots_ints[0]
+                spots_vol[tt]      =  res.spots_vol[0]
+                spts_lbls          =  label(np.sign(res.spots_ints[0]))
+                if merge_radius > 0:                                                                               # dilation to aggregate pieces, label and remove the dilation
+                    spts_bw    =  binary_dilation(np.sign(spts_lbls), np.ones((merge_radius, merge_radius)))
+                    spts_lbls  =  label(spts_bw) * np.sign(spts_lbls)
+                spots_2d_lbls[tt]  =  spts_lbls
+                res.spots_coords.astype(np.int16).tofile(coords_file)
+                n_coords          +=  res.spots_coords.shape[0]
+                if progress_callback is not None:
+                    progress_callback(tt + 1, tlen)
+
+        spots_coords  =  np.lib.format.open_memmap(out_folder + '/spots_coords_stream.npy', mode='w+', dtype=np.int16, shape=(n_coords + 1, 4))
+        if n_coords > 0:
+            spots_coords[:-1]  =  np.memmap(out_folder + '/spots_coords_stream.bin', dtype=np.int16, mode='r', shape=(n_coords, 4))
+        spots_coords[-1]  =  tlen, zlen, xlen, ylen                                                                # last row gives info on the raw data size
+        os.remove(out_folder + '/spots_coords_stream.bin')
+
+        spots_ints.flush()
+        spots_vol.flush()
+        spots_2d_lbls.flush()
+        spots_coords.flush()
+
+        self.spots_ints     =  spots_ints
+        self.spots_vol      =  spots_vol
+        self.spots_coords   =  spots_coords
+        self.spots_2d_lbls  =  spots_2d_lbls
@@ -1,14 +1,14 @@
 """This function estimates the background of detected spots.
 
-Input are spots_3D_coords and 2D tracked spots.
+Input are spots_3D_coords and 2D tracked spots, and the minimum number of active
+frames of a track; progress goes to progress_callback(done, total), if given.
 """
 
-import multiprocessing
 import numpy as np
 from skimage.measure import regionprops_table
 from skimage.segmentation import expand_labels
 
-import ServiceWidgets
+import WorkersPool
 
 
 def reconstruc3d(spots_3d_coords_def, frame):
@@ -24,9 +24,8 @@ def reconstruc3d(spots_3d_coords_def, frame):
 
 class SpotsFeatureExtractor:
     """Define spots cages and measure the background for each of them."""
-    def __init__(self, spots_trckd, spots_3d_coords, raw_data):
+    def __init__(self, spots_trckd, spots_3d_coords, raw_data, min_act_frames, progress_callback=None):
 
-        min_act_frames  =  ServiceWidgets.InputScalar.getFlag(["Act frames thr:", " ", "Enter", "Minimum number of non-zeros frames to keep the nuclear time trace", "Enter the value", "Active Frames"])
         # cpu_owe         =  multiprocessing.cpu_count()
 
         rgp_spts_trckd  =  regionprops_table(spots_trckd, properties=["label", "coords"])
@@ -38,12 +37,9 @@ class SpotsFeatureExtractor:
         spots_idxs      =  np.unique(spots_trckd[spots_trckd != 0])     # collect tags in increasing order
         spots_features  =  np.zeros((tlen, 7, spots_idxs.size))         # initialize output matrix (for each spot at each time frame we have volume, intensity, background value, intensity divided by background and the 3D coordinate of the centroid)
 
-        pbar  =  ServiceWidgets.ProgressBar(total1=tlen)
-        pbar.update_progressbar1(0)
-        pbar.show()
-
         for tt in range(tlen):
-            pbar.update_progressbar1(tt)
+            if progress_callback is not None:
+                progress_callback(tt, tlen)
             spots_fr   =  reconstruc3d(spots_3d_coords, tt)                                                                        # reconstruct spot in 3d (it is b&w)
             spots_fr  *=  spots_trckd[tt]                                                                                          # give proper label to the 3d spots
             cage_fr    =  expand_labels(spots_fr, 5) - expand_labels(spots_fr, 3)                                                  # expand in 3d each label 5 times and subtract the same label expoanded 3 times to have cages around
@@ -53,7 +49,8 @@ class SpotsFeatureExtractor:
                 lb_idx                         =  np.where(lb == spots_idxs)[0]
                 spots_features[tt, :, lb_idx]  =  rgp_spots["area"][cnt], np.sum(rgp_spots["intensity_image"][cnt]), np.sum(rgp_cage["intensity_image"][cnt]) / rgp_cage["area"][cnt], np.sum(rgp_spots["intensity_image"][cnt]) / (np.sum(rgp_cage["intensity_image"][cnt]) / rgp_cage["area"][cnt]), rgp_spots["centroid-0"][cnt], rgp_spots["centroid-1"][cnt], rgp_spots["centroid-2"][cnt]
 
-        pbar.close()
+        if progress_callback is not None:
+            progress_callback(tlen, tlen)
 
         self.spots_features  =  spots_features
         self.spots_idxs      =  spots_idxs
@@ -62,9 +59,7 @@ class SpotsFeatureExtractor:
 
 class SpotsFeatureExtractor2:
     """Coordinate the multiprocessed action of the utility function tio calculate the background of each spot."""
-    def __init__(self, spots_trckd, spots_3d_coords, raw_data):
-
-        min_act_frames  =  ServiceWidgets.InputScalar.getFlag(["Act frames thr:", " ", "Enter", "Minimum number of non-zeros frames to keep the nuclear time trace", "Enter the value", "Active Frames"])
+    def __init__(self, spots_trckd, spots_3d_coords, raw_data, min_act_frames, workers):
 
         rgp_spts_trckd  =  regionprops_table(spots_trckd, properties=["label", "coords"])
         for kk in rgp_spts_trckd["coords"]:
@@ -74,16 +69,14 @@ class SpotsFeatureExtractor2:
         tlen            =  spots_trckd.shape[0]                         # number of time steps
         spots_idxs      =  np.unique(spots_trckd[spots_trckd != 0])     # collect tags in increasing order
 
-        cpu_own  =  multiprocessing.cpu_count()
+        cpu_own  =  workers
         if tlen > 5 * cpu_own:
             t_chops     =  np.array_split(np.arange(tlen), cpu_own)
             args_input  =  []
             for mm in range(cpu_own):
                 args_input.append([spots_trckd[t_chops[mm]], spots_idxs, spots_3d_coords, raw_data[t_chops[mm]], t_chops[mm]])
 
-            pool     =  multiprocessing.Pool()
-            results  =  pool.map(SpotsFeatureExtractorUtility, args_input)
-            pool.close()
+            results  =  WorkersPool.get_pool(cpu_own).map(SpotsFeatureExtractorUtility, args_input)
 
             self.spots_features  =  results[0].spots_features
             for k in range(1, len(results)):
@@ -1,77 +1,212 @@
 """This function tracks spots in 2D keeping anyway all the 3D information.
 
 Input is spots already detected by another function and distance threshold (user defined).
+Centroids are grouped frame by frame and each frame has its own KD-tree, so the spots
+close to a track are searched only among the few centroids near it in the following frame.
+Tracks are linked in one of two modes (setting stored in 'link_mode.npy'): 'greedy' (the
+original one) follows each track to its end before starting the next one, so an early
+track can take the spot a later one needed; 'global' links all the tracks together frame
+after frame, solving the assignment of the tracks to the spots of the following frame.
+There is no GUI here: progress goes to progress_callback(done, total), if given.
 """
 
 
+import os.path
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage.measure import regionprops_table    # , label
 # from skimage.morphology import binary_dilation
-from PyQt5 import QtWidgets, QtCore
 
 
-def dist_one_several(ctrs_ref_bff, t2search_bff, lb_step_cntrds_bff):
-    """This function calculates the distance between one centroid and all the centroids of the following frame."""
-    lb_step_cntrds_bff_sub  =  lb_step_cntrds_bff[lb_step_cntrds_bff[:, 1] == t2search_bff]         # isolate from the matrix all the centroids of the frame to search
-    if lb_step_cntrds_bff_sub.size == 0:                                                            # if in the considered frame there are no spots, put just a super high distance value
-        dists  =  [1000000, 100000, 100000, 100000]
-    else:
-        dists  =  []
-        for k in range(lb_step_cntrds_bff_sub.shape[0]):                                            # calculate the distance between the reference point and all the centroids of the considered frame (to speed up the code other values are stored)
-            dists.append([lb_step_cntrds_bff_sub[k, 0], lb_step_cntrds_bff_sub[k, 2], lb_step_cntrds_bff_sub[k, 3], np.sqrt((ctrs_ref_bff[0] - lb_step_cntrds_bff_sub[k, 2])**2 + (ctrs_ref_bff[1] - lb_step_cntrds_bff_sub[k, 3])**2)])
+GAP_FRAMES  =  8                                                                                # number of consecutive frames a track can miss its spot
+LINK_MODES  =  ["greedy", "global"]
 
-    dists  =  np.asarray(dists)                                                                 # easier to work with array for these tasks
-    if len(dists.shape) == 1:
-        dists  =  np.expand_dims(dists, axis=0)                                                     # dists must be a nx4 array, that's way we add a dimension
-    return dists
+
+def read_link_mode():
+    """Read the linking mode setting ('link_mode.npy', 'greedy' if missing)."""
+    if os.path.isfile('link_mode.npy'):
+        return str(np.load('link_mode.npy'))
+    return "greedy"
+
+
+def spots_centroids(spts_2d_lbls):
+    """Labels and rounded centroids (2D) of the spots, frame after frame: the spots of frame t are the rows frame_ptr[t]:frame_ptr[t + 1]."""
+    tlen       =  spts_2d_lbls.shape[0]
+    lbls       =  []
+    cntrs      =  []
+    frame_ptr  =  np.zeros(tlen + 1, dtype=np.int64)
+    for tt in range(tlen):
+        rgp_bff_clean      =  regionprops_table(np.asarray(spts_2d_lbls[tt]), properties=["label", "centroid"])
+        lbls.append(rgp_bff_clean["label"])
+        cntrs.append(np.round(np.stack([rgp_bff_clean["centroid-0"], rgp_bff_clean["centroid-1"]], axis=1)).astype(int))
+        frame_ptr[tt + 1]  =  frame_ptr[tt] + rgp_bff_clean["label"].size
+
+    return np.concatenate(lbls).astype(int), np.concatenate(cntrs).reshape(-1, 2), frame_ptr
+
+
+class FramesNeighbours:
+    """KD-trees of the centroids of each frame, to search the closest spot not tracked yet."""
+    def __init__(self, cntrs, frame_ptr, dist_thr):
+
+        self.cntrs      =  cntrs
+        self.frame_ptr  =  frame_ptr
+        self.dist_thr   =  dist_thr
+        self.radius     =  dist_thr * (1 + 1e-9) + 1e-9                                         # a bit larger than dist_thr: the distance check is done again below
+        self.trees      =  [cKDTree(cntrs[frame_ptr[tt]:frame_ptr[tt + 1]]) if frame_ptr[tt + 1] > frame_ptr[tt] else None for tt in range(frame_ptr.size - 1)]
+
+    def closest(self, ctrs_ref, tt, taken):
+        """Index of the spot of frame tt closest to ctrs_ref within the distance threshold and not taken (-1 if there is none)."""
+        if self.trees[tt] is None:
+            return -1
+        cands  =  np.sort(self.trees[tt].query_ball_point(ctrs_ref, self.radius)).astype(np.int64) + self.frame_ptr[tt]     # candidates in frame order, so ties go to the first spot as before
+        cands  =  cands[~taken[cands]]
+        if cands.size == 0:
+            return -1
+        dists  =  np.sqrt((ctrs_ref[0] - self.cntrs[cands, 0]) ** 2 + (ctrs_ref[1] - self.cntrs[cands, 1]) ** 2)
+        cc     =  np.argmin(dists)
+        return cands[cc] if dists[cc] <= self.dist_thr else -1
+
+
+def link_greedy(cntrs, frame_ptr, dist_thr, progress_callback=None):
+    """Tag of each spot: each track is followed to its end (starting from the first spot not tracked yet) taking at each frame the closest free spot."""
+    tlen          =  frame_ptr.size - 1
+    spts_frame    =  np.repeat(np.arange(tlen), np.diff(frame_ptr))                                 # time step of each spot
+    neighbours    =  FramesNeighbours(cntrs, frame_ptr, dist_thr)
+    taken         =  np.zeros(cntrs.shape[0], dtype=bool)                                           # spots already in a track
+    spts_tags     =  np.zeros(cntrs.shape[0], dtype=np.int64)
+
+    new_tags      =  0                                                                              # initialize tag to associate for the final trzacking
+    empty_frames  =  0
+    seed          =  0                                                                              # first spot not tracked yet: spots are sorted in time, so each track starts from the beginning
+    t_prgr        =  -1                                                                             # frame of the seeds reported to progress_callback
+    while True:                                                                                     # loop until all the spots are tracked
+        while seed < taken.size and taken[seed]:                                                    # the pointer only moves forward: spots before it are all tracked
+            seed  +=  1
+        if seed == taken.size:
+            break
+        if progress_callback is not None and spts_frame[seed] > t_prgr:                              # progress is reported once per frame, not once per track
+            t_prgr  =  spts_frame[seed]
+            progress_callback(t_prgr, tlen)
+        new_tags          +=  1                                                                     # update the new tag
+        t_start            =  spts_frame[seed]                                                      # appearence frame for the spot
+        ctrs_ref           =  cntrs[seed]                                                           # centroid coordinate as a reference
+        spts_tags[seed]    =  new_tags                                                              # add the spot to the track with the proper tag
+        taken[seed]        =  True                                                                  # the spot is not available anymore
+        while t_start < tlen - 1:
+            cc  =  neighbours.closest(ctrs_ref, t_start + 1, taken)                                 # closest free spot in the following frame, if close enough
+            if cc >= 0:                                                                             # if there is a spot close enough we engage it
+                ctrs_ref       =  cntrs[cc]                                                         # update the centroid reference
+                t_start       +=  1                                                                 # update the current time
+                spts_tags[cc]  =  new_tags                                                          # add the new spot with the proper tag
+                taken[cc]      =  True                                                              # remove the selected spot
+                empty_frames   =  0
+            elif empty_frames < GAP_FRAMES:
+                t_start       +=  1                                                                 # in case there is no spot close enough (or in the considered frame there are no spots at all) we check in the following frame keeping the same reference centroid
+                empty_frames  +=  1
+            else:
+                break
+
+    if progress_callback is not None:
+        progress_callback(tlen, tlen)
+    return spts_tags
+
+
+def frame_links(refs, cntrs, dist_thr):
+    """Links between the reference centroids of the tracks and the centroids of a frame closer than dist_thr: as many links as possible, with the smallest total distance. Output are the indexes of the linked tracks and spots."""
+    no_links  =  np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if refs.shape[0] == 0 or cntrs.shape[0] == 0:
+        return no_links
+
+    pairs   =  cKDTree(refs).sparse_distance_matrix(cKDTree(cntrs), dist_thr * (1 + 1e-9) + 1e-9, output_type="ndarray")
+    ii, jj  =  pairs["i"].astype(np.int64), pairs["j"].astype(np.int64)
+    dd      =  np.sqrt((refs[ii, 0] - cntrs[jj, 0]) ** 2 + (refs[ii, 1] - cntrs[jj, 1]) ** 2)         # same distance of the greedy mode
+    close   =  dd <= dist_thr
+    ii, jj, dd  =  ii[close], jj[close], dd[close]
+    if ii.size == 0:
+        return no_links
+
+    ntrks                 =  refs.shape[0]
+    graph                 =  coo_matrix((np.ones(ii.size), (ii, ntrks + jj)), shape=(ntrks + cntrs.shape[0],) * 2)
+    _, comps              =  connected_components(graph, directed=False)                        # tracks and spots competing for the same links
+    edge_comps            =  comps[ii]
+    order                 =  np.argsort(edge_comps, kind="stable")
+    _, comp_start, comp_cnt  =  np.unique(edge_comps[order], return_index=True, return_counts=True)
+
+    single                =  order[comp_start[comp_cnt == 1]]                                   # one track and one spot: nothing to choose
+    trks_lnk, spts_lnk    =  [ii[single]], [jj[single]]
+    for start, cnt in zip(comp_start[comp_cnt > 1], comp_cnt[comp_cnt > 1]):
+        edges                =  order[start:start + cnt]
+        c_trks, e_trks       =  np.unique(ii[edges], return_inverse=True)
+        c_spts, e_spts       =  np.unique(jj[edges], return_inverse=True)
+        no_link              =  dist_thr * (min(c_trks.size, c_spts.size) + 1) + 1                 # higher than any sum of distances: one more link always wins
+        cost                 =  np.full((c_trks.size, c_spts.size), no_link)
+        cost[e_trks, e_spts] =  dd[edges]
+        rr, cc               =  linear_sum_assignment(cost)
+        linked               =  cost[rr, cc] < no_link
+        trks_lnk.append(c_trks[rr[linked]])
+        spts_lnk.append(c_spts[cc[linked]])
+
+    return np.concatenate(trks_lnk), np.concatenate(spts_lnk)
+
+
+def link_global(cntrs, frame_ptr, dist_thr, progress_callback=None):
+    """Tag of each spot: frame after frame, all the active tracks are linked together to the spots of the frame (the same track can skip GAP_FRAMES frames), the other spots start new tracks."""
+    tlen       =  frame_ptr.size - 1
+    spts_tags  =  np.zeros(cntrs.shape[0], dtype=np.int64)
+    trk_ref    =  np.zeros((cntrs.shape[0], 2), dtype=np.float64)                                   # reference centroid of each track (there are at most as many tracks as spots)
+    trk_last   =  np.zeros(cntrs.shape[0], dtype=np.int64)                                          # last frame of each track
+    active     =  np.zeros(0, dtype=np.int64)                                                       # tracks that can still be continued
+    ntrks      =  0
+    for tt in range(tlen):
+        if progress_callback is not None:
+            progress_callback(tt, tlen)
+        spts                =  frame_ptr[tt] + np.lexsort(cntrs[frame_ptr[tt]:frame_ptr[tt + 1]].T[::-1])     # spots sorted by position, so that ties do not depend on the labels order
+        active              =  active[tt - trk_last[active] - 1 <= GAP_FRAMES]
+        trks_lnk, spts_lnk  =  frame_links(trk_ref[active], cntrs[spts], dist_thr)
+        trks_lnk            =  active[trks_lnk]
+        spts_lnk            =  spts[spts_lnk]
+
+        spts_new            =  spts[~np.isin(spts, spts_lnk)]                                       # spots not linked start new tracks
+        trks_new            =  np.arange(ntrks, ntrks + spts_new.size)
+        ntrks              +=  spts_new.size
+        active              =  np.concatenate([active, trks_new])
+
+        trks                =  np.concatenate([trks_lnk, trks_new])
+        spts_trk            =  np.concatenate([spts_lnk, spts_new])
+        spts_tags[spts_trk] =  trks + 1
+        trk_ref[trks]       =  cntrs[spts_trk]
+        trk_last[trks]      =  tt
+
+    if progress_callback is not None:
+        progress_callback(tlen, tlen)
+    return spts_tags
 
 
 class SpotsTracker:
     """Main class, does all the job."""
-    def __init__(self, spts_2d_lbls, dist_thr):
-
-        tlen           =  spts_2d_lbls.shape[0]
-        lb_step_cntds  =  []                                                                            # list of spots properties: label, t step and centroids (2D)
-        for tt in range(tlen):
-            rgp_bff_clean  =  regionprops_table(spts_2d_lbls[tt], properties=["label", "centroid"])
-            for cnt, ll in enumerate(rgp_bff_clean["label"]):
-                lb_step_cntds.append([ll, tt, np.round(rgp_bff_clean["centroid-0"][cnt]).astype(int), np.round(rgp_bff_clean["centroid-1"][cnt]).astype(int)])
-
-        lb_step_cntds  =  np.asarray(lb_step_cntds)                                                      # np array is easier to handle
-        spts_trck_fin  =  np.zeros_like(spts_2d_lbls)                                                    # initialize the output matrix
-
-        pb        =  QtWidgets.QProgressBar()
-        pb.setRange(0, 0)
-        pb.show()
-        new_tags      =  0                                                                                   # initialize tag to associate for the final trzacking
-        empty_frames  =  0
-        while np.sum(lb_step_cntds) > 0:                                                                 # while loop to be sure all the spots are tracked
-            QtCore.QCoreApplication.processEvents()
-            new_tags                           +=  1                                                     # update the new tag
-            lb_step_cntds                       =  lb_step_cntds[lb_step_cntds[:, 1].argsort()]          # since we start from the spot first listed in the coordinate, we sort with the time to be sure to not pick a spot from an arbitrary frame and not from the beginning
-            t_start                             =  lb_step_cntds[0, 1]                                   # appearence frame for the spot
-            ctrs_ref                            =  lb_step_cntds[0, 2:]                                  # centroid coordinate as a reference
-            spts_trck_fin[lb_step_cntds[0, 1]] +=  (spts_2d_lbls[lb_step_cntds[0, 1]] == lb_step_cntds[0, 0]) * new_tags     # add the spot in the final matrix with the proper tag
-            lb_step_cntds                       =  lb_step_cntds[1:]                                     # remove the added spot properties from the list
-            while t_start < tlen - 1:
-                dd  =  dist_one_several(ctrs_ref, t_start + 1, lb_step_cntds)                            # calculate the distance between the selected spot and all the other in the following frames
-                # print(dd.shape)
-                if dd[:, 3].min() <= dist_thr:                                                            # if there is a spot close enough we engage it
-                    # print(dd[:, 3].min())
-                    cc                      =  np.argmin(dd[:, 3])                                       # search the matrix index in the distance matrix of the closest spot
-                    ctrs_ref                =  dd[cc, 1:3]                                               # update the centroid reference
-                    t_start                +=  1                                                         # update the current time
-                    spts_trck_fin[t_start] +=  (spts_2d_lbls[t_start] == int(dd[cc, 0])) * new_tags      # add the new spot with the proper tag
-                    # print(np.where(np.sum(np.abs(lb_step_cntds - np.array([dd[cc, 0], t_start, dd[cc, 1], dd[cc, 2]])), axis=1) == 0))
-                    lb_step_cntds           =  np.delete(lb_step_cntds, np.where(np.sum(np.abs(lb_step_cntds - np.array([dd[cc, 0], t_start, dd[cc, 1], dd[cc, 2]])), axis=1) == 0), axis=0)   # remove the properties of the selected spot
-                    empty_frames            =  0
-                elif dd[:, 3].min() > dist_thr:
-                    if empty_frames < 8:
-                        t_start       +=  1                                                               # in case the minimum is bigger than the distance threshold (or in the considered frame there are no spots at all) we check in the following frame keeping the same reference centroid
-                        empty_frames  +=  1
-                    elif empty_frames >= 8:
-                        break
-
-        pb.close()
+    def __init__(self, spts_2d_lbls, dist_thr, link_mode="greedy", progress_callback=None):
+
+        if link_mode not in LINK_MODES:
+            raise ValueError("Unknown linking mode: " + str(link_mode))
+
+        lbls, cntrs, frame_ptr  =  spots_centroids(spts_2d_lbls)                                    # spots properties: label and centroids (2D), grouped by time step
+        spts_trck_fin           =  np.zeros(spts_2d_lbls.shape, dtype=spts_2d_lbls.dtype)           # initialize the output matrix
+
+        if link_mode == "global":
+            spts_tags  =  link_global(cntrs, frame_ptr, dist_thr, progress_callback)
+        else:
+            spts_tags  =  link_greedy(cntrs, frame_ptr, dist_thr, progress_callback)
+
+        for tt in range(spts_2d_lbls.shape[0]):
+            if frame_ptr[tt + 1] > frame_ptr[tt]:
+                spts_sl            =  slice(frame_ptr[tt], frame_ptr[tt + 1])
+                spts_frame         =  np.asarray(spts_2d_lbls[tt])
+                lut                =  np.zeros(int(spts_frame.max()) + 1, dtype=spts_trck_fin.dtype)     # label -> tag of the frame (background stays 0)
+                lut[lbls[spts_sl]] =  spts_tags[spts_sl]
+                spts_trck_fin[tt]  =  lut[spts_frame]                                               # all the spots of the frame painted with their tags in one pass
+
         self.spts_trck_fin  =  spts_trck_fin
         self.orig_tags      =  []
@@ -0,0 +1,57 @@
+"""This function manages the multiprocessing pool shared by all the tools of the software.
+
+The pool is created the first time some work is submitted and then it is reused by spots
+detection, feature extraction and photobleaching, so the workers start (and import scipy,
+skimage...) only once per session. The number of workers is a setting stored in
+'workers_numb.npy' (0 or missing file means one worker per cpu): the GUI reads it with
+workers_numb() and gives it to the tools, which pass it to get_pool.
+Workers are not forked from the GUI process (which may hold raw data at that moment):
+they start from a clean process ('forkserver', or 'spawn' where it is missing), so a
+loaded stack is freed as soon as the GUI drops it. Tasks carry only descriptors and
+frames.
+"""
+
+import os.path
+import multiprocessing
+from multiprocessing import resource_tracker
+import numpy as np
+
+
+POOL          =  None                  # the pool, created lazily
+POOL_SIZE     =  0                     # number of workers of the pool
+START_METHOD  =  "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"     # workers never start as a fork of the GUI process
+
+
+def workers_numb():
+    """Read the number of workers to use."""
+    numb  =  0
+    if os.path.isfile('workers_numb.npy'):
+        numb  =  int(np.load('workers_numb.npy'))
+    if numb <= 0:
+        numb  =  multiprocessing.cpu_count()
+    return numb
+
+
+def get_pool(workers):
+    """Give the pool of workers, creating it if needed (or if the number of workers changed)."""
+    global POOL, POOL_SIZE
+
+    numb  =  max(1, int(workers))
+    if POOL is not None and POOL_SIZE != numb:
+        close_pool()
+    if POOL is None:
+        resource_tracker.ensure_running()                   # workers must share the tracker of the main process, otherwise they would unlink the shared memory blocks at their exit
+        POOL       =  multiprocessing.get_context(START_METHOD).Pool(numb)     # no copy on write mapping of the GUI memory in the workers
+        POOL_SIZE  =  numb
+    return POOL
+
+
+def close_pool():
+    """Stop the workers: to call when the software is closed."""
+    global POOL, POOL_SIZE
+
+    if POOL is not None:
+        POOL.close()
+        POOL.join()
+    POOL       =  None
+    POOL_SIZE  =  0
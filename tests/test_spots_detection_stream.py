@@ -0,0 +1,37 @@
+"""This function checks SpotsDetectionStream against SpotsDetectionChopper on a synthetic stack."""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SpotsDetectionChopper
+import SpotsDetectionStream
+import WorkersPool
+
+
+def synthetic_stack():
+    """T-z-x-y poisson background with bright spots moving in time."""
+    rng    =  np.random.default_rng(2)
+    stack  =  rng.poisson(20, (6, 7, 48, 40)).astype(np.uint16)
+    for tt in range(stack.shape[0]):
+        stack[tt, 2:5, 10 + tt:13 + tt, 10:13]  +=  800
+        stack[tt, 3:6, 30:34, 20 + tt:23 + tt]  +=  600
+    return stack
+
+
+def test_stream_matches_chopper(tmp_path):
+    """merge_radius = 0: same intensity, volume, labels and coordinates of the chopper."""
+    stack  =  synthetic_stack()
+    try:
+        chop  =  SpotsDetectionChopper.SpotsDetectionChopper(stack, 4, 2, 0, 1.5, 1)
+        strm  =  SpotsDetectionStream.SpotsDetectionStream(iter(stack), stack.shape[0], stack.shape[1:], 4, 2, 0, str(tmp_path), 1.5, 2)
+    finally:
+        WorkersPool.close_pool()
+
+    assert chop.spots_ints.max() > 0
+    np.testing.assert_array_equal(strm.spots_ints, chop.spots_ints)
+    np.testing.assert_array_equal(strm.spots_vol, chop.spots_vol)
+    np.testing.assert_array_equal(strm.spots_2d_lbls, chop.spots_2d_lbls)
+    np.testing.assert_array_equal(strm.spots_coords, chop.spots_coords)
@@ -0,0 +1,95 @@
+"""This function checks the greedy linking of SpotsTracker against the original tracking loop on fixed synthetic label stacks."""
+
+import os
+import sys
+import numpy as np
+from skimage.measure import regionprops_table
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SpotsTracker
+
+
+def reference_greedy(spts_2d_lbls, dist_thr):
+    """Original greedy tracker (without GUI): each track is followed to its end taking at each frame the closest spot left, up to GAP_FRAMES empty frames."""
+    tlen           =  spts_2d_lbls.shape[0]
+    lb_step_cntds  =  []                                                                        # label, t step and rounded centroid of each spot
+    for tt in range(tlen):
+        rgp  =  regionprops_table(spts_2d_lbls[tt], properties=["label", "centroid"])
+        for cnt, ll in enumerate(rgp["label"]):
+            lb_step_cntds.append([ll, tt, np.round(rgp["centroid-0"][cnt]).astype(int), np.round(rgp["centroid-1"][cnt]).astype(int)])
+
+    lb_step_cntds  =  np.asarray(lb_step_cntds).reshape(-1, 4)
+    spts_trck_fin  =  np.zeros_like(spts_2d_lbls)
+    new_tags       =  0
+    empty_frames   =  0                                                                         # not reset between tracks, as in the original loop
+    while lb_step_cntds.shape[0] > 0:
+        new_tags                 +=  1
+        lb_step_cntds             =  lb_step_cntds[lb_step_cntds[:, 1].argsort(kind="stable")]
+        t_start                   =  lb_step_cntds[0, 1]
+        ctrs_ref                  =  lb_step_cntds[0, 2:]
+        spts_trck_fin[t_start]   +=  (spts_2d_lbls[t_start] == lb_step_cntds[0, 0]) * new_tags
+        lb_step_cntds             =  lb_step_cntds[1:]
+        while t_start < tlen - 1:
+            sub    =  lb_step_cntds[lb_step_cntds[:, 1] == t_start + 1]
+            dists  =  np.sqrt((ctrs_ref[0] - sub[:, 2]) ** 2 + (ctrs_ref[1] - sub[:, 3]) ** 2) if sub.shape[0] > 0 else np.array([np.inf])
+            if dists.min() <= dist_thr:
+                cc                       =  np.argmin(dists)
+                ctrs_ref                 =  sub[cc, 2:]
+                t_start                 +=  1
+                spts_trck_fin[t_start]  +=  (spts_2d_lbls[t_start] == sub[cc, 0]) * new_tags
+                lb_step_cntds            =  lb_step_cntds[np.any(lb_step_cntds != sub[cc], axis=1)]
+                empty_frames             =  0
+            elif empty_frames < SpotsTracker.GAP_FRAMES:
+                t_start       +=  1
+                empty_frames  +=  1
+            else:
+                break
+
+    return spts_trck_fin
+
+
+def synthetic_labels(tlen, size, n_tracks, seed):
+    """Label stack of 3x3 spots random-walking in time, with random missing frames and spurious spots."""
+    rng    =  np.random.default_rng(seed)
+    lbls   =  np.zeros((tlen, size, size), dtype=np.int32)
+    pos    =  rng.uniform(5, size - 5, (n_tracks, 2))
+    start  =  rng.integers(0, tlen, n_tracks)
+    life   =  rng.integers(3, tlen, n_tracks)
+    for tt in range(tlen):
+        pos  =  np.clip(pos + rng.normal(0, 1.5, pos.shape), 3, size - 4)
+        ll   =  1
+        for k in range(n_tracks):
+            if start[k] <= tt < start[k] + life[k] and rng.random() > 0.1:
+                x, y                            =  pos[k].astype(int)
+                lbls[tt, x - 1:x + 2, y - 1:y + 2]  =  ll
+                ll                              +=  1
+        for x, y in rng.integers(3, size - 4, (rng.integers(0, 4), 2)):
+            lbls[tt, x - 1:x + 2, y - 1:y + 2]  =  ll
+            ll                                  +=  1
+    return lbls
+
+
+def test_greedy_matches_reference():
+    """Same tracked stack of the original greedy loop, for a few movies and distance thresholds."""
+    for seed in range(3):
+        lbls  =  synthetic_labels(40, 64, 25, seed)
+        for dist_thr in [3, 6, 10]:
+            trck  =  SpotsTracker.SpotsTracker(lbls, dist_thr).spts_trck_fin
+            np.testing.assert_array_equal(trck, reference_greedy(lbls, dist_thr))
+
+
+def test_greedy_gaps():
+    """A spot missing for GAP_FRAMES frames keeps its tag, one missing for GAP_FRAMES + 1 frames starts a new track."""
+    gap                          =  SpotsTracker.GAP_FRAMES
+    lbls                         =  np.zeros((gap + 4, 50, 50), dtype=np.int32)
+    lbls[0, 9:12, 9:12]          =  1                                                           # spot A: frame 0, back after GAP_FRAMES empty frames
+    lbls[gap + 1, 10:13, 9:12]   =  1
+    lbls[0, 39:42, 39:42]        =  2                                                           # spot B: frame 0, back after GAP_FRAMES + 1 empty frames
+    lbls[gap + 2, 39:42, 40:43]  =  1
+
+    trck  =  SpotsTracker.SpotsTracker(lbls, 5).spts_trck_fin
+    np.testing.assert_array_equal(trck, reference_greedy(lbls, 5))
+    assert trck[0, 10, 10] == trck[gap + 1, 11, 10] == 1
+    assert trck[0, 40, 40] == 2
+    assert trck[gap + 2, 40, 41] == 3
@@ -0,0 +1,42 @@
+"""This function checks thr_stats against scipy.stats.norm.fit on a synthetic filtered frame."""
+
+import os
+import sys
+import numpy as np
+from scipy.stats import norm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SpotsDetection3D
+
+
+def synthetic_frame():
+    """Float32 z-x-y frame with a gaussian background and a few bright cubes, as after the filtering."""
+    rng  =  np.random.default_rng(1)
+    frm  =  rng.normal(3.0, 2.0, (9, 120, 130)).astype(np.float32)
+    for z, x, y in rng.integers(1, 100, (12, 3)):
+        frm[z % 7:z % 7 + 3, x:x + 4, y:y + 4]  +=  40
+    return frm
+
+
+def test_thr_stats_full_matches_norm_fit():
+    """thr_sample = 0: identical threshold of norm.fit, with and without scratch buffer."""
+    frm        =  synthetic_frame()
+    mu, sigma  =  norm.fit(frm)
+    for thr_val in [0, 2.5, 7]:
+        ref  =  mu + thr_val * sigma
+        np.testing.assert_equal(SpotsDetection3D.thr_stats(frm, thr_val), ref)
+        np.testing.assert_equal(SpotsDetection3D.thr_stats(frm, thr_val, buff=np.empty_like(frm)), ref)
+        np.testing.assert_equal(SpotsDetection3D.thr_stats(frm, thr_val, n_sample=frm.size), ref)
+
+
+def test_thr_stats_sampled_bound():
+    """thr_sample > 0: error within 5 standard errors of the estimate of mu + thr_val * sigma, and repeatable."""
+    frm        =  synthetic_frame()
+    mu, sigma  =  norm.fit(frm)
+    thr_val    =  4
+    for n_sample in [10000, 100000]:
+        thr_smp  =  SpotsDetection3D.thr_stats(frm, thr_val, n_sample=n_sample)
+        bound    =  5 * sigma * np.sqrt(1 + thr_val ** 2 / 2) / np.sqrt(n_sample)
+        assert abs(thr_smp - (mu + thr_val * sigma)) < bound
+        assert thr_smp == SpotsDetection3D.thr_stats(frm, thr_val, n_sample=n_sample)